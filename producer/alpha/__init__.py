@@ -1,9 +1,11 @@
+import itertools
 import logging
 import os
 import platform
 import sys
 import time
 
+import cv2
 import numpy as np
 import torch
 
@@ -16,12 +18,72 @@ from alphapose.utils.vis import getTime
 from alphapose.utils.writer import DataWriter
 
 from producer.helpers import output_json_exists
+from producer.backends import PoseBackend
+from producer.resultcache import get_result_cache
+from producer.video import FrameSampling, read_frames
+
+
+def frame_order(result):
+    """Sort key of a writer result, the frame's index in the video."""
+    return int(result["imgname"].split('.')[0])
+
+
+class SampledDetectionLoader(DetectionLoader):
+    """
+    `DetectionLoader` for a video that only decodes the frames selected by a `FrameSampling`, frames
+    `skip(frame_num)` is true for (their results are cached) are left out as well.
+    """
+
+    def __init__(self, input_source, detector, cfg, opt, sampling, batchSize=1, queueSize=128, skip=None):
+        super().__init__(input_source, detector, cfg, opt, mode="video", batchSize=batchSize, queueSize=queueSize)
+        frame_nums = list(sampling.frame_nums(self.fps, self.datalen)) if self.datalen > 0 else []
+        self.skipped = [frame_num for frame_num in frame_nums if skip is not None and skip(frame_num)]
+        skipped = set(self.skipped)
+        # the detection threads read `datalen` frames in `num_batches` batches
+        self.frame_nums = [frame_num for frame_num in frame_nums if frame_num not in skipped]
+        self.datalen = len(self.frame_nums)
+        self.num_batches = (self.datalen + batchSize - 1) // batchSize
+
+    def frame_preprocess(self):
+        stream = cv2.VideoCapture(self.path)
+        assert stream.isOpened(), 'Cannot capture source'
+        frames = read_frames(stream, self.frame_nums)
+        for i in range(self.num_batches):
+            imgs = []
+            orig_imgs = []
+            im_names = []
+            im_dim_list = []
+            for frame_num, frame in itertools.islice(frames, self.batchSize):
+                if self.stopped:
+                    break
+                img_k = self.detector.image_preprocess(frame)
+                if isinstance(img_k, np.ndarray):
+                    img_k = torch.from_numpy(img_k)
+                # add one dimension at the front for batch if image shape (3,h,w)
+                if img_k.dim() == 3:
+                    img_k = img_k.unsqueeze(0)
+                imgs.append(img_k)
+                orig_imgs.append(frame[:, :, ::-1])
+                # named after the frame's index in the video so results line up with the video
+                im_names.append(str(frame_num) + '.jpg')
+                im_dim_list.append((frame.shape[1], frame.shape[0]))
+            if imgs:
+                with torch.no_grad():
+                    imgs = torch.cat(imgs)
+                    im_dim_list = torch.FloatTensor(im_dim_list).repeat(1, 2)
+                self.wait_and_put(self.image_queue, (imgs, orig_imgs, im_names, im_dim_list))
+            if len(orig_imgs) < min(self.batchSize, self.datalen - i * self.batchSize):
+                # the video ended before the frame count said it would
+                self.wait_and_put(self.image_queue, (None, None, None, None))
+                break
+        stream.release()
 
 
 class AlphaPoser:
 
     def __init__(self, config_path, checkpoint, single_process=False, detbatch=5, posebatch=80, gpu=None,
-                 detector="yolo", qsize=1024, output_format="coco", output_indexed=False, pose_track=False):
+                 detector="yolo", qsize=1024, output_format="coco", output_indexed=False, pose_track=False,
+                 precision=None, execution=None):
         #========================
         self.sp = self._single_process = single_process
         if not self._single_process:
@@ -57,20 +119,47 @@ class AlphaPoser:
         self.pose_model.load_state_dict(torch.load(self.checkpoint, map_location=self.device))
         self.pose_model.to(self.device)
         self.pose_model.eval()
+        self.pose_backend = PoseBackend.from_settings(self.pose_model, self.config.DATA_PRESET.IMAGE_SIZE, self.checkpoint, device=self.device,
+                                                      precision=precision, execution=execution)
         self.detector_instance = get_detector(self)
         self.outputpath = ""
 
-    def process_video(self, input_path, output_path):
+    def process_video(self, input_path, output_path, sampling=None):
         if output_json_exists(output_path):
             logging.info("output exists, skipping")
             return
         if not os.path.exists(output_path):
             os.makedirs(output_path)
         self.outputpath = output_path
-        det_loader = DetectionLoader(input_path, self.detector_instance, self.config, self, batchSize=self.detbatch, mode="video").start()
+        # frames finished by an earlier attempt come from the result cache, tracking needs every frame in order
+        cache = None if self.pose_track else get_result_cache()
+        model_id = f"{self.pose_backend.model_id}:{self.detector}"
+        # the writer results of the cached frames, read as the loader is built so an entry evicted by
+        # this run's own results does not leave its frame out
+        cached_results = {}
+
+        def cache_key(name):
+            return cache.key(input_path, name, model_id)
+
+        def skip(frame_num):
+            cached = cache.get(cache_key(str(frame_num) + '.jpg'))
+            if cached is None or "result" not in cached:
+                return False
+            cached_results[str(frame_num) + '.jpg'] = cached["result"]
+            return True
+
+        if cache is not None:
+            det_loader = SampledDetectionLoader(input_path, self.detector_instance, self.config, self, sampling or FrameSampling(),
+                                                batchSize=self.detbatch, skip=skip).start()
+        elif sampling is None:
+            det_loader = DetectionLoader(input_path, self.detector_instance, self.config, self, batchSize=self.detbatch, mode="video").start()
+        else:
+            det_loader = SampledDetectionLoader(input_path, self.detector_instance, self.config, self, sampling, batchSize=self.detbatch).start()
         # Init data writer
         writer = DataWriter(self.config, self, save_video=False, queueSize=self.qsize).start()
-
+        if cached_results:
+            logging.info("%s frames from the result cache", len(cached_results))
+        estimated = []
         data_len = det_loader.length
         try:
             logging.info("inferring poses....")
@@ -82,6 +171,7 @@ class AlphaPoser:
                     if orig_img is None:
                         logging.info("orig_img is None, must be done")
                         break
+                    estimated.append(os.path.basename(im_name))
                     if boxes is None or boxes.nelement() == 0:
                         logging.info("no poses in frame")
                         writer.save(None, None, None, None, None, orig_img, os.path.basename(im_name))
@@ -97,7 +187,7 @@ class AlphaPoser:
                     hm = []
                     for j in range(num_batches):
                         inps_j = inps[j * self.posebatch:min((j + 1) * self.posebatch, datalen)]
-                        hm_j = self.pose_model(inps_j)
+                        hm_j = self.pose_backend(inps_j)
                         hm.append(hm_j)
                     hm = torch.cat(hm)
                     logging.info("moving to CPU")
@@ -114,6 +204,8 @@ class AlphaPoser:
                 logging.info('===========================> Rendering remaining %s images in the queue...', str(writer.count()))
             writer.stop()
             det_loader.stop()
+            if cache is not None:
+                self.cache_results(cache, cache_key, writer.results(), estimated)
         except KeyboardInterrupt:
             # logging.info_finish_info()
             # Thread won't be killed when press Ctrl+C
@@ -129,8 +221,22 @@ class AlphaPoser:
                 writer.clear_queues()
                 # det_loader.clear_queues()
         final_result = writer.results()
+        if cached_results:
+            # merged in the video's order, as the frames would have been written
+            final_result = sorted(list(final_result) + [{"imgname": im_name, "result": result} for im_name, result in cached_results.items() if result],
+                                  key=frame_order)
         write_json(final_result, self.outputpath, form=self.output_format, for_eval=self.output_indexed)
         logging.info("Results have been written to json.")
         del det_loader
         del writer
         del final_result
+
+    @staticmethod
+    def cache_results(cache, cache_key, final_result, im_names):
+        """
+        Caches the writer results (keypoints, scores and boxes) of the frames `im_names` estimated now,
+        frames the writer has no result for had no poses.
+        """
+        results = {result["imgname"]: result["result"] for result in final_result}
+        for im_name in im_names:
+            cache.put(cache_key(im_name), {"result": results.get(im_name, [])})
@@ -0,0 +1,444 @@
+"""
+Inference backends for the pose model and the YOLO detector.
+
+`ModelBackend` runs an eager model (`eager`, the default), a frozen TorchScript trace of it
+(`torchscript`) or an ONNX export through ONNX Runtime (`onnx`). The exported backends can quantize
+the model to int8:
+
+    dynamic     weights are quantized ahead of time, activations on the fly (`onnx` only, TorchScript
+                would only quantize the linear layers, which these models barely have)
+    static      weights and activations are quantized, activation ranges are calibrated on a tensor of
+                model inputs saved with `torch.save` (`POSE_CALIBRATION`, `DETECTOR_CALIBRATION`)
+
+Exported models are written to `MODEL_EXPORT_DIRECTORY` under a name derived from the checkpoint, so
+the processors of a worker export them once. The backend is built in the process that first calls it,
+TorchScript modules and ONNX Runtime sessions are not carried into spawned workers. The exported
+backends only run on the CPU, check them against the eager models with `scripts/check_pose_backend.py`
+and `scripts/bench_detector.py` before rolling them out.
+
+The eager backend can also run the pose model in reduced precision (`bf16`, `fp16`) and with the
+execution modes `compile` (`torch.compile`), `channels_last` and `inference_mode`. When it does, the
+first call checks the heatmap peaks (the keypoints) against the fp32 model on the calibration inputs
+(random crops without them) and falls back to fp32 when they move by more than `check_tolerance`
+heatmap pixels on average (`check_tolerance=None` skips the check).
+
+`DetectorBackend` replaces the `images_detection` of an AlphaPose YOLO detector. The darknet model runs
+through a `ModelBackend` and the person detections are selected with the NMS below instead of the
+detector's CUDA extension.
+"""
+import copy
+import hashlib
+import logging
+import os
+import tempfile
+
+import torch
+
+from producer import settings as s
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+BACKENDS = ("eager", "torchscript", "onnx")
+QUANTIZATIONS = ("none", "dynamic", "static")
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+EXECUTION_MODES = ("compile", "channels_last", "inference_mode")
+
+INPUT_NAME = "input"
+
+# the detector's NMS threshold is lowered once when a batch has more detections than this
+MAX_DETECTIONS = 100
+
+
+def model_key(checkpoint, input_size):
+    """Names the exports of a checkpoint, a new checkpoint at the same path gets new exports."""
+    stat = os.stat(checkpoint)
+    digest = hashlib.sha1(f"{os.path.abspath(checkpoint)}:{stat.st_size}:{stat.st_mtime_ns}:{tuple(input_size)}".encode()).hexdigest()
+    return f"{os.path.splitext(os.path.basename(checkpoint))[0]}-{digest[:12]}"
+
+
+def detector_key(detector):
+    inp_dim = int(getattr(detector, "inp_dim", 0))
+    weights = getattr(detector, "model_weights", None)
+    return model_key(weights, (inp_dim, inp_dim)) if weights and os.path.exists(weights) else "detector"
+
+
+def load_calibration(path):
+    return torch.load(path, map_location="cpu") if path else None
+
+
+def execution_modes(value):
+    """`compile,channels_last` (or a sequence of modes) as a tuple of modes."""
+    if isinstance(value, str):
+        value = value.split(",")
+    return tuple(mode.strip() for mode in value or () if mode.strip())
+
+
+def _replace_atomically(path, write):
+    """Writes `path` through a temporary file, processors exporting at the same time do not see partial files."""
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=os.path.splitext(path)[1])
+    os.close(handle)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class _CalibrationBatches:
+    # ONNX Runtime's `CalibrationDataReader` interface, defined here so the module imports without it
+
+    def __init__(self, calibration, batch_size):
+        self._batches = iter([{INPUT_NAME: chunk.numpy()} for chunk in calibration.split(batch_size)])
+
+    def get_next(self):
+        return next(self._batches, None)
+
+
+class ModelBackend:
+
+    output_name = "output"
+
+    def __init__(self, model, input_shape, backend="eager", quantization="none", threads=0, cache_dir=None,
+                 key="model", calibration=None, device="cpu", calibration_batch_size=16, precision="fp32", execution=()):
+        if backend not in BACKENDS:
+            raise ValueError(f"unknown model backend `{backend}`, expected one of {BACKENDS}")
+        quantization = quantization or "none"
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"unknown quantization `{quantization}`, expected one of {QUANTIZATIONS}")
+        if quantization != "none" and backend == "eager":
+            raise ValueError("quantized models need the `torchscript` or `onnx` backend")
+        if quantization == "dynamic" and backend == "torchscript":
+            raise ValueError("dynamic quantization of `torchscript` models leaves their convolutions in fp32, "
+                             "use `static` quantization or the `onnx` backend")
+        if quantization == "static" and calibration is None:
+            raise ValueError("static quantization needs calibration inputs")
+        if backend == "onnx" and onnxruntime is None:
+            raise ValueError("the onnx backend requires the `onnxruntime` package")
+        if backend != "eager" and torch.device(device).type != "cpu":
+            raise ValueError(f"the {backend} backend runs on the CPU, not on {device}")
+        precision = precision or "fp32"
+        if precision not in PRECISIONS:
+            raise ValueError(f"unknown precision `{precision}`, expected one of {tuple(PRECISIONS)}")
+        execution = execution_modes(execution)
+        unknown = set(execution) - set(EXECUTION_MODES)
+        if unknown:
+            raise ValueError(f"unknown execution modes {sorted(unknown)}, expected some of {EXECUTION_MODES}")
+        if (precision != "fp32" or execution) and backend != "eager":
+            raise ValueError("reduced precision and execution modes need the `eager` backend")
+        self.model = model
+        # shape of one input, without the batch dimension
+        self.input_shape = tuple(input_shape)
+        self.backend = backend
+        self.quantization = quantization
+        self.threads = threads
+        self.cache_dir = cache_dir or tempfile.gettempdir()
+        self.key = key
+        self.calibration = calibration
+        self.calibration_batch_size = calibration_batch_size
+        self.device = device
+        self.precision = precision
+        self.execution = execution
+        self._runner = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_runner'] = None
+        return state
+
+    def __call__(self, inps):
+        if self._runner is None:
+            self._runner = self.load()
+        return self._runner(inps)
+
+    @property
+    def model_id(self):
+        """Names the model and how it is run, results of different ids may differ."""
+        model_id = f"{self.key}-{self.backend}-{self.quantization}"
+        return model_id if self.precision == "fp32" else f"{model_id}-{self.precision}"
+
+    @property
+    def export_path(self):
+        suffix = ".onnx" if self.backend == "onnx" else ".pt"
+        return os.path.join(self.cache_dir, f"{self.model_id}{suffix}")
+
+    def example_input(self, batch_size=1):
+        return torch.rand(batch_size, *self.input_shape)
+
+    def export_model(self):
+        """The eager model to export."""
+        return self.model.cpu().eval()
+
+    def load(self):
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        if self.backend == "eager":
+            return self.eager_runner() if self.precision != "fp32" or self.execution else self.model
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if not os.path.exists(self.export_path):
+            logging.info("exporting the model to %s", self.export_path)
+            _replace_atomically(self.export_path, self.export_torchscript if self.backend == "torchscript" else self.export_onnx)
+        if self.backend == "torchscript":
+            module = torch.jit.load(self.export_path, map_location="cpu")
+            # the optimized graph holds prepacked weights that cannot be saved, optimize after loading
+            return torch.jit.optimize_for_inference(module.eval())
+        return self.onnx_runner(self.export_path)
+
+    def eager_runner(self):
+        dtype = PRECISIONS[self.precision]
+        memory_format = torch.channels_last if "channels_last" in self.execution else torch.contiguous_format
+        model = self.model
+        if self.precision != "fp32" or "channels_last" in self.execution:
+            # the fp32 model stays as it is, it is the reference of the self-check
+            model = copy.deepcopy(model).to(dtype=dtype, memory_format=memory_format)
+        if "compile" in self.execution:
+            model = torch.compile(model)
+        inference_mode = "inference_mode" in self.execution
+        grad_mode = torch.inference_mode if inference_mode else torch.no_grad
+
+        def run(inps):
+            with grad_mode():
+                output = model(inps.to(dtype=dtype, memory_format=memory_format))
+            # float32 outputs, copied out of inference mode so they can be used like any other tensor
+            return output.to(torch.float32, copy=inference_mode)
+        return run
+
+    def quantized_model(self):
+        model = copy.deepcopy(self.export_model())
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+        prepared = prepare_fx(model, get_default_qconfig_mapping("x86"), example_inputs=(self.example_input(),))
+        with torch.no_grad():
+            for chunk in self.calibration.split(self.calibration_batch_size):
+                prepared(chunk)
+        return convert_fx(prepared)
+
+    def export_torchscript(self, path):
+        model = self.quantized_model() if self.quantization != "none" else self.export_model()
+        with torch.no_grad():
+            traced = torch.jit.trace(model, self.example_input(2))
+            frozen = torch.jit.freeze(traced.eval())
+        torch.jit.save(frozen, path)
+
+    def export_onnx(self, path):
+        fp32_path = path if self.quantization == "none" else f"{path}.fp32.onnx"
+        try:
+            with torch.no_grad():
+                torch.onnx.export(self.export_model(), (self.example_input(2),), fp32_path, dynamo=False, opset_version=17,
+                                  input_names=[INPUT_NAME], output_names=[self.output_name],
+                                  dynamic_axes={INPUT_NAME: {0: "batch"}, self.output_name: {0: "batch"}})
+            if self.quantization == "none":
+                return
+            from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+            from onnxruntime.quantization.shape_inference import quant_pre_process
+            prepared_path = f"{path}.prepared.onnx"
+            quant_pre_process(fp32_path, prepared_path)
+            os.replace(prepared_path, fp32_path)
+            if self.quantization == "dynamic":
+                quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+            else:
+                quantize_static(fp32_path, path, _CalibrationBatches(self.calibration, self.calibration_batch_size),
+                                quant_format=QuantFormat.QDQ, per_channel=True,
+                                activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        finally:
+            if fp32_path != path and os.path.exists(fp32_path):
+                os.remove(fp32_path)
+
+    def onnx_runner(self, path):
+        options = onnxruntime.SessionOptions()
+        # the processors already run one per share of the cores, see `QueueWorkProcessor.processor`
+        options.intra_op_num_threads = self.threads or torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+        def run(inps):
+            output, = session.run([self.output_name], {INPUT_NAME: inps.detach().cpu().float().numpy()})
+            return torch.from_numpy(output)
+        return run
+
+
+class PoseBackend(ModelBackend):
+
+    output_name = "heatmaps"
+
+    def __init__(self, model, input_size, check_tolerance=1.0, **kwargs):
+        super().__init__(model, (3, *input_size), **kwargs)
+        self.check_tolerance = check_tolerance
+
+    @classmethod
+    def from_settings(cls, model, input_size, checkpoint, device="cpu", precision=None, execution=None):
+        precision = precision or s.POSE_PRECISION
+        execution = execution_modes(s.POSE_EXECUTION if execution is None else execution)
+        # the calibration inputs are also what the self-check of reduced precision runs on
+        calibrated = s.POSE_QUANTIZATION == "static" or precision != "fp32" or execution
+        return cls(model, input_size, backend=s.POSE_BACKEND, quantization=s.POSE_QUANTIZATION, threads=s.POSE_THREADS,
+                   cache_dir=s.MODEL_EXPORT_DIRECTORY or None, key=model_key(checkpoint, input_size),
+                   calibration=load_calibration(s.POSE_CALIBRATION) if calibrated else None,
+                   device=device, precision=precision, execution=execution, check_tolerance=s.POSE_CHECK_TOLERANCE)
+
+    @property
+    def model_id(self):
+        """Names the model as it will run, the self-check runs first as it may fall back to fp32."""
+        if self._runner is None and (self.precision != "fp32" or self.execution):
+            self._runner = self.load()
+        return super().model_id
+
+    def load(self):
+        runner = super().load()
+        if self.backend != "eager" or runner is self.model or self.check_tolerance is None:
+            return runner
+        try:
+            error = self.keypoint_error(runner)
+        except Exception:
+            logging.exception("the %s pose model with %s failed its self-check", self.precision, self.execution)
+            error = float("inf")
+        if error > self.check_tolerance:
+            logging.warning("keypoints of the %s pose model with %s are %.3f heatmap pixels off fp32, falling back to fp32",
+                            self.precision, self.execution, error)
+            self.precision, self.execution = "fp32", ()
+            return self.model
+        logging.info("keypoints of the %s pose model with %s are %.3f heatmap pixels off fp32", self.precision, self.execution, error)
+        return runner
+
+    def keypoint_error(self, runner):
+        """Mean distance (in heatmap pixels) between the heatmap peaks of `runner` and the fp32 model."""
+        inps = self.calibration if self.calibration is not None else self.example_input(self.calibration_batch_size)
+        distances = []
+        for chunk in inps[:64].split(self.calibration_batch_size):
+            chunk = chunk.to(self.device)
+            with torch.no_grad():
+                reference = self.model(chunk).float()
+            heatmaps = runner(chunk).float()
+            distances.append((heatmap_peaks(heatmaps) - heatmap_peaks(reference)).norm(dim=2).flatten().cpu())
+        return torch.cat(distances).mean().item()
+
+
+def heatmap_peaks(heatmaps):
+    """`x, y` of the maximum of every heatmap of an N x K x H x W batch."""
+    flat = heatmaps.flatten(2).argmax(dim=2)
+    return torch.stack([flat % heatmaps.shape[3], flat // heatmaps.shape[3]], dim=2).float()
+
+
+class _YoloPrediction(torch.nn.Module):
+    # the darknet model takes the detector options as a second argument
+
+    def __init__(self, model, args):
+        super().__init__()
+        self.model = model
+        self.args = args
+
+    def forward(self, imgs):
+        return self.model(imgs, args=self.args)
+
+
+class YoloBackend(ModelBackend):
+
+    output_name = "prediction"
+
+    def __init__(self, detector, **kwargs):
+        inp_dim = int(detector.inp_dim)
+        super().__init__(None, (3, inp_dim, inp_dim), key=detector_key(detector), **kwargs)
+        self.detector = detector
+
+    def export_model(self):
+        # AlphaPose detectors load their model on the first detection
+        if not self.detector.model:
+            self.detector.load_model()
+        return _YoloPrediction(self.detector.model, self.detector.detector_opt).cpu().eval()
+
+
+def box_iou(boxes):
+    """IoU of every pair of `x1, y1, x2, y2` boxes, areas count the edge pixels as the detector's NMS does."""
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    top_left = torch.max(boxes[:, None, :2], boxes[None, :, :2])
+    bottom_right = torch.min(boxes[:, None, 2:], boxes[None, :, 2:])
+    overlap = (bottom_right - top_left + 1).clamp(min=0).prod(dim=2)
+    return overlap / (areas[:, None] + areas[None, :] - overlap)
+
+
+def nms(boxes, scores, threshold):
+    """Indices of the boxes kept by greedy NMS, highest score first."""
+    order = scores.argsort(descending=True)
+    iou = box_iou(boxes[order])
+    keep = torch.ones(len(order), dtype=torch.bool)
+    for i in range(len(order)):
+        if keep[i]:
+            keep[i + 1:] &= iou[i, i + 1:] <= threshold
+    return order[keep]
+
+
+def write_results(prediction, confidence, num_classes, nms_thres):
+    """
+    Person detections of a YOLO prediction (N x boxes x 5 + classes, center and size in input pixels)
+    as rows of `image index, x1, y1, x2, y2, objectness, class score, class`, 0 without any.
+    """
+    output = []
+    for ind, image_pred in enumerate(prediction.float()):
+        image_pred = image_pred[image_pred[:, 4] > confidence]
+        class_conf, class_pred = image_pred[:, 5:5 + num_classes].max(1)
+        # only people are kept
+        image_pred, class_conf = image_pred[class_pred == 0], class_conf[class_pred == 0]
+        if not len(image_pred):
+            continue
+        half_size = image_pred[:, 2:4] / 2
+        boxes = torch.cat((image_pred[:, :2] - half_size, image_pred[:, :2] + half_size), 1)
+        keep = nms(boxes, image_pred[:, 4], nms_thres)
+        output.append(torch.cat((
+            torch.full((len(keep), 1), float(ind)), boxes[keep], image_pred[keep, 4:5], class_conf[keep, None],
+            torch.zeros(len(keep), 1)), 1))
+    return torch.cat(output) if output else 0
+
+
+def rescale_detections(dets, orig_dim_list, inp_dim):
+    """Detections from letterboxed input coordinates back to their frames, `orig_dim_list` rows are `w, h, w, h`."""
+    orig_dim_list = orig_dim_list[dets[:, 0].long()]
+    scaling_factor = torch.min(inp_dim / orig_dim_list, 1)[0].view(-1, 1)
+    dets[:, [1, 3]] -= (inp_dim - scaling_factor * orig_dim_list[:, 0:1]) / 2
+    dets[:, [2, 4]] -= (inp_dim - scaling_factor * orig_dim_list[:, 1:2]) / 2
+    dets[:, 1:5] /= scaling_factor
+    dets[:, [1, 3]] = torch.min(dets[:, [1, 3]].clamp(min=0), orig_dim_list[:, 0:1])
+    dets[:, [2, 4]] = torch.min(dets[:, [2, 4]].clamp(min=0), orig_dim_list[:, 1:2])
+    return dets
+
+
+class DetectorBackend:
+
+    def __init__(self, detector, backend="torchscript", quantization="none", threads=0, cache_dir=None,
+                 calibration=None, device="cpu"):
+        if not hasattr(detector, "inp_dim"):
+            raise ValueError("exported detector backends only support the YOLO detectors")
+        self.inp_dim = int(detector.inp_dim)
+        self.confidence = detector.confidence
+        self.nms_thres = detector.nms_thres
+        self.num_classes = detector.num_classes
+        self.model = YoloBackend(detector, backend=backend, quantization=quantization, threads=threads,
+                                 cache_dir=cache_dir, calibration=calibration, device=device)
+
+    @classmethod
+    def from_settings(cls, detector, backend=None, quantization=None, threads=None, calibration=None, device="cpu"):
+        quantization = quantization or s.DETECTOR_QUANTIZATION
+        calibration = calibration or s.DETECTOR_CALIBRATION
+        return cls(detector, backend=backend or s.DETECTOR_BACKEND, quantization=quantization,
+                   threads=s.DETECTOR_THREADS if threads is None else threads, cache_dir=s.MODEL_EXPORT_DIRECTORY or None,
+                   calibration=load_calibration(calibration) if quantization == "static" else None, device=device)
+
+    @property
+    def model_id(self):
+        return self.model.model_id
+
+    def images_detection(self, imgs, orig_dim_list):
+        """Same rows as the detector's `images_detection`, 0 when nothing was detected."""
+        with torch.no_grad():
+            prediction = self.model(imgs)
+            dets = write_results(prediction, self.confidence, self.num_classes, self.nms_thres)
+            if not isinstance(dets, int) and dets.shape[0] > MAX_DETECTIONS:
+                dets = write_results(prediction, self.confidence, self.num_classes, self.nms_thres - 0.05)
+            if isinstance(dets, int) or dets.shape[0] == 0:
+                return 0
+            return rescale_detections(dets, orig_dim_list.float(), self.inp_dim)
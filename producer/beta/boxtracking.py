@@ -4,10 +4,10 @@ import os
 import time
 from uuid import uuid4
 
-import redis
-
+from producer.beta.gating import is_reuse_marker
 from producer.beta.loader import QueueWorkProcessor, ResultTarget
 from producer.helpers import rabbit_params, now, packb, unpackb
+from producer.redisclient import get_redis
 
 
 class BoxTrackerWorker(QueueWorkProcessor):
@@ -19,12 +19,15 @@ class BoxTrackerWorker(QueueWorkProcessor):
         return unpackb(message)
 
     def process_batch(self, batch):
-        redis_conn = redis.Redis(host="redis")
         results = []
+        # the records and manifests of the whole batch are written in one round trip
+        pipe = get_redis().pipeline(transaction=False)
         for image in batch:
+            if is_reuse_marker(image):
+                results.append(image)
+                continue
             image_id = str(uuid4())
-            base = {
-                "image_id": image_id,
+            record = {
                 "orig_img": image["orig_img"],
                 "im_name": image["im_name"],
                 "path": image["path"],
@@ -35,12 +38,20 @@ class BoxTrackerWorker(QueueWorkProcessor):
             }
             box_ids = []
             for box in image["boxes"]:
-                box.update(base)
+                # the frame is stored once with the image record, boxes reference it by image id
+                box["image_id"] = image_id
                 box_id = str(uuid4())
                 box["box_id"] = box_id
                 box_ids.append(box_id)
-                results.append(packb(box))
-            redis_conn.sadd(f"input.{image_id}.manifest", *box_ids)
+                results.append(box)
+            # the record holds the frame until the estimator has finished its last box, it does not expire
+            # as the boxes may wait in the queue for any time. With the frame store it is a reference,
+            # without it the pixels (compressed when IMAGE_CODECS names `orig_img`), one frame per image
+            # in flight.
+            pipe.set(f"image.{image_id}", packb(record))
+            pipe.set(f"image.{image_id}.boxes", len(box_ids))
+            pipe.sadd(f"input.{image_id}.manifest", *box_ids)
+        pipe.execute()
         return results
 
 
@@ -48,6 +59,6 @@ if __name__ == '__main__':
     from alphapose.utils.config import update_config
     cfg = update_config("/data/alphapose-training/data/pose_cfgs/wf_alphapose_inference_config.yaml")
     worker = BoxTrackerWorker(rabbit_params(), 'box-tracker', result_queue=ResultTarget('boxes', 'estimation'))
-    preloader, processor = worker.start()
+    worker.start()
     while not worker.stopped:
         time.sleep(5)
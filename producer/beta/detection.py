@@ -8,94 +8,137 @@ import torch
 
 from alphapose.utils.config import update_config
 from alphapose.utils.detector import DetectionLoader
-from alphapose.utils.presets import SimpleTransform
-from alphapose.models import builder
 from detector.apis import get_detector
 import numpy as np
 
+from producer.backends import DetectorBackend, detector_key
+from producer.beta.gating import split_markers
 from producer.beta.loader import QueueWorkProcessor, ResultTarget
-from producer.helpers import rabbit_params, packb, unpackb, columnarize, ObjectView
-
-
+from producer.beta.regions import RegionFilters
+from producer.beta.transforms import letterbox_batch
+from producer import framestore
+from producer.helpers import rabbit_params, unpackb, column_views, ObjectView
+from producer.resultcache import get_result_cache
+from producer import settings as s
+
+
+def parse_buckets(spec, batch_size):
+    """
+    Batch sizes the detector runs, short batches are padded to the smallest that fits. `none` runs
+    every batch at its own size, an empty spec uses the powers of two up to `batch_size`.
+    """
+    spec = (spec or "").strip().lower()
+    if spec == "none":
+        return []
+    if spec:
+        return sorted({int(size) for size in spec.split(",")})
+    buckets = [1]
+    while buckets[-1] < batch_size:
+        buckets.append(min(buckets[-1] * 2, batch_size))
+    return buckets
+
+
+def crop_window(frame, window):
+    if window is None:
+        return frame
+    x0, y0, x1, y1 = window
+    return frame[y0:y1, x0:x1]
 
 
 class ImageDetectionWorker(QueueWorkProcessor):
 
-    def __init__(self, detector_cfg, detector_args, connection_params, source_queue_name, result_queue=None, batch_size=2, max_queue_size=4):
+    def __init__(self, detector_cfg, detector_args, connection_params, source_queue_name, result_queue=None, batch_size=2, max_queue_size=4, buckets=None,
+                 backend=None, quantization=None, threads=None, calibration=None, regions_config=None):
         super().__init__(connection_params, source_queue_name, result_queue=result_queue, batch_size=batch_size, max_queue_size=max_queue_size)
+        self.buckets = parse_buckets(s.DETECTION_BATCH_BUCKETS if buckets is None else buckets, batch_size)
         self.detector_cfg = detector_cfg
         self.detector_args = detector_args
         self.detector = get_detector(detector_args, detector_cfg['DETECTOR'])
-        self._input_size = detector_cfg.DATA_PRESET.IMAGE_SIZE
-        self._output_size = detector_cfg.DATA_PRESET.HEATMAP_SIZE
-        self._sigma = detector_cfg.DATA_PRESET.SIGMA
-        if detector_cfg.DATA_PRESET.TYPE == 'simple':
-            pose_dataset = builder.retrieve_dataset(self.detector_cfg.DATASET.TRAIN)
-            self.transformation = SimpleTransform(
-                pose_dataset, scale_factor=0,
-                input_size=self._input_size,
-                output_size=self._output_size,
-                rot=0, sigma=self._sigma,
-                train=False, add_dpg=False, gpu_device=detector_args.device)
+        backend = backend or s.DETECTOR_BACKEND
+        if backend != "eager":
+            # same `images_detection` contract, the model runs exported and NMS does not need the CUDA extension
+            self.detector = DetectorBackend.from_settings(self.detector, backend, quantization, threads, calibration, device=detector_args.device)
+        # names the detector in result cache keys
+        self.model_id = getattr(self.detector, "model_id", None) or f"{detector_key(self.detector)}-eager-none"
+        self.regions = RegionFilters.load(s.REGIONS_CONFIG if regions_config is None else regions_config)
 
     def prepare_single(self, message):
         decoded = unpackb(message)
         return decoded
 
     def process_batch(self, batch):
-        columns = columnarize(batch, ["img", "orig_img", "im_name", "im_dim", "date", "path", "assignment_id", "environment_id", "timestamp"])
-        imgs = columns["img"]
+        # frames the motion gate replaced by reuse markers are passed on as they are
+        markers, batch = split_markers(batch)
+        batch, frames = self.resolve_frames(batch)
+        if not batch:
+            return markers
+        columns = column_views(batch, ["img", "orig_img", "im_name", "date", "path", "assignment_id", "environment_id", "timestamp"])
         orig_imgs = columns["orig_img"]
         im_names = columns["im_name"]
-        im_dim_list = columns["im_dim"]
         date = columns["date"]
         path = columns["path"]
         assignment_id = columns["assignment_id"]
         environment_id = columns["environment_id"]
         timestamp = columns["timestamp"]
-        with torch.no_grad():
-            imgs = torch.cat(imgs)
-            im_dim_list = torch.FloatTensor(im_dim_list).repeat(1, 2)
+        filters = [self.regions.get(assignment) for assignment in assignment_id]
+        # frames with a region of interest are detected in its bounding rectangle
+        windows = [f.window(frame.shape[1], frame.shape[0]) if f else None for f, frame in zip(filters, frames)]
+        # messages from imagers that still ship the preprocessed image
+        for img in columns["img"]:
+            framestore.release(img)
 
         with torch.no_grad():
-            # pad useless images to fill a batch, else there will be a bug
-            for pad_i in range(self.batch_size - len(imgs)):
-                imgs = torch.cat((imgs, torch.unsqueeze(imgs[0], dim=0)), 0)
-                im_dim_list = torch.cat((im_dim_list, torch.unsqueeze(im_dim_list[0], dim=0)), 0)
-
-            dets = self.detector.images_detection(imgs, im_dim_list)
-            if isinstance(dets, int) or dets.shape[0] == 0:
+            # frames detected before (the video is being processed again) come from the result cache
+            cache = get_result_cache()
+            cache_keys = [cache.key(path[k], im_names[k], self.model_id, windows[k] or "") for k in range(len(frames))] if cache else []
+            cached = [cache.get(key) for key in cache_keys] if cache else [None] * len(frames)
+            todo = [k for k, hit in enumerate(cached) if hit is None]
+            dets = [torch.cat((torch.full((len(hit["dets"]), 1), float(k)), hit["dets"]), 1)
+                    for k, hit in enumerate(cached) if hit is not None]
+            if todo:
+                inputs = [crop_window(frames[k], windows[k]) for k in todo]
+                detected = self.detect(inputs, torch.FloatTensor([image.shape[1::-1] for image in inputs]).repeat(1, 2))
+                # back to the frame's index in the batch and its coordinates
+                offsets = torch.FloatTensor([(windows[k] or (0, 0))[:2] for k in todo]).repeat(1, 2)
+                detected[:, 1:5] += offsets[detected[:, 0].long()]
+                detected[:, 0] = torch.tensor(todo, dtype=detected.dtype)[detected[:, 0].long()]
+                dets.append(detected)
+                if cache:
+                    for k in todo:
+                        cache.put(cache_keys[k], {"dets": detected[detected[:, 0] == k, 1:]})
+            dets = torch.cat(dets)
+            dets = self.filter_boxes(dets, filters)
+            if dets.shape[0] == 0:
                 logging.info("nothing detected")
-                return []
-            if isinstance(dets, np.ndarray):
-                dets = torch.from_numpy(dets)
-            dets = dets.cpu()
+                for oimg in orig_imgs:
+                    framestore.release(oimg)
+                return markers
+            image_index = dets[:, 0].long()
             boxes = dets[:, 1:5]
             scores = dets[:, 5:6]
             ids = torch.zeros(scores.shape)
 
         results = []
         for k, oimg in enumerate(orig_imgs):
-            boxes_k = boxes[dets[:, 0] == k]
-            if isinstance(boxes_k, int) or boxes_k.shape[0] == 0:
+            in_image = image_index == k
+            if not in_image.any():
+                framestore.release(oimg)
                 continue
-            inps = torch.zeros(boxes_k.size(0), 3, *self._input_size)
-            cropped_boxes = torch.zeros(boxes_k.size(0), 4)
-            self.crop_images(boxes_k, oimg, inps, cropped_boxes)
+            # a frame store reference is forwarded as it is, the box tracker takes over its count
             orig_img = oimg
             im_name = im_names[k]
-            scores_k = scores[dets[:, 0] == k]
-            ids_k = ids[dets[:, 0] == k]
+            boxes_k = boxes[in_image]
+            scores_k = scores[in_image]
+            ids_k = ids[in_image]
             image_result = []
+            # the estimator crops the boxes out of the frame, a box is its own crop spec
             for index, box in enumerate(boxes_k):
                 image_result.append({
                     "score": scores_k[index],
                     "id": ids_k[index],
-                    "inp": inps[index],
-                    "cropped_box": cropped_boxes[index],
                     "box": box,
                 })
-            results.append(packb({
+            results.append({
                 "orig_img": orig_img,
                 "im_name": im_name,
                 "path": path[k],
@@ -104,21 +147,81 @@ class ImageDetectionWorker(QueueWorkProcessor):
                 "environment_id": environment_id[k],
                 "timestamp": timestamp[k],
                 "boxes": image_result,
-            }))
-        return results
-
-    def crop_images(self, boxes, orig_img, inps, cropped_boxes):
-        with torch.no_grad():
-            if boxes is None or boxes.nelement() == 0:
-                return
-            for i, box in enumerate(boxes):
-                inps[i], cropped_box = self.transformation.test_transform(orig_img, box)
-                cropped_boxes[i] = torch.FloatTensor(cropped_box)
+            })
+        return markers + results
+
+    @staticmethod
+    def resolve_frames(batch):
+        """The messages of `batch` whose frame can be read and their frames, the others are dropped."""
+        resolved, frames = [], []
+        for image in batch:
+            try:
+                frames.append(framestore.resolve(image["orig_img"]))
+            except FileNotFoundError:
+                logging.error("the frame of %s of %s is no longer in the frame store, dropping it", image["im_name"], image["path"])
+                framestore.release(image.get("img"))
+                continue
+            resolved.append(image)
+        return resolved, frames
+
+    @staticmethod
+    def filter_boxes(dets, filters):
+        keep = torch.ones(len(dets), dtype=torch.bool)
+        for k, region_filter in enumerate(filters):
+            in_image = dets[:, 0] == k
+            if region_filter is not None and in_image.any():
+                keep[in_image] = region_filter.keep(dets[in_image, 1:5], dets[in_image, 5])
+        return dets[keep]
+
+    def detect(self, frames, im_dim_list):
+        """Detector rows (`index, x1, y1, x2, y2, ...`) for `frames`, an empty tensor when nothing was detected."""
+        imgs = self.preprocess(frames)
+        # pad to a bucket size with copies of the first image, their detections are dropped below
+        padding = self.bucket_size(len(imgs)) - len(imgs)
+        if padding > 0:
+            imgs = torch.cat((imgs, imgs[:1].expand(padding, *imgs.shape[1:])), 0)
+            im_dim_list = torch.cat((im_dim_list, im_dim_list[:1].expand(padding, -1)), 0)
+        dets = self.detector.images_detection(imgs, im_dim_list)
+        if isinstance(dets, int) or dets.shape[0] == 0:
+            return torch.zeros(0, 8)
+        if isinstance(dets, np.ndarray):
+            dets = torch.from_numpy(dets)
+        dets = dets.cpu().float()
+        # detections in the padding images are dropped
+        return dets[dets[:, 0] < len(frames)]
+
+    def preprocess(self, orig_imgs):
+        """
+        Detector input for a batch of RGB frames. YOLO detectors (with an `inp_dim`) are letterboxed as a
+        batch, other detectors get `image_preprocess` frame by frame.
+        """
+        inp_dim = getattr(self.detector, "inp_dim", None)
+        if inp_dim:
+            return letterbox_batch(orig_imgs, int(inp_dim))
+        imgs = []
+        for orig_img in orig_imgs:
+            # `image_preprocess` expects the BGR frame as it was decoded
+            img = self.detector.image_preprocess(np.ascontiguousarray(orig_img[:, :, ::-1]))
+            if isinstance(img, np.ndarray):
+                img = torch.from_numpy(img)
+            # add one dimension at the front for batch if image shape (3,h,w)
+            if img.dim() == 3:
+                img = img.unsqueeze(0)
+            imgs.append(img)
+        return torch.cat(imgs)
+
+    def bucket_size(self, count):
+        """Batch size the detector runs for `count` images, batches larger than every bucket are not padded."""
+        return next((bucket for bucket in self.buckets if bucket >= count), count)
 
 
 @click.command()
 @click.option('--device')
-def main(device="cpu"):
+@click.option('--backend', default=None, help="eager, torchscript or onnx (DETECTOR_BACKEND)")
+@click.option('--quantization', default=None, help="none, dynamic or static (DETECTOR_QUANTIZATION)")
+@click.option('--threads', default=None, type=int, help="intra-op threads of the exported detector (DETECTOR_THREADS)")
+@click.option('--calibration', default=None, help="letterboxed frames saved with torch.save for static quantization (DETECTOR_CALIBRATION)")
+def main(device="cpu", backend=None, quantization=None, threads=None, calibration=None):
     gpus = []
     if device != "cpu":
         gpus = [int(device)]
@@ -131,8 +234,9 @@ def main(device="cpu"):
         "gpus": gpus,
     })
     cfg = update_config("/data/alphapose-training/data/pose_cfgs/wf_alphapose_inference_config.yaml")
-    worker = ImageDetectionWorker(cfg, args, rabbit_params(), 'detection', result_queue=ResultTarget('boxes', 'catalog'))
-    preloader, processor = worker.start()
+    worker = ImageDetectionWorker(cfg, args, rabbit_params(), 'detection', result_queue=ResultTarget('boxes', 'catalog'),
+                                  backend=backend, quantization=quantization, threads=threads, calibration=calibration)
+    worker.start()
     while not worker.stopped:
         time.sleep(5)
 
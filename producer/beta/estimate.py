@@ -1,3 +1,4 @@
+from collections import defaultdict
 import json
 import logging
 import os
@@ -12,17 +13,29 @@ from alphapose.utils.transforms import get_func_heatmap_to_coord
 # from alphapose.utils.pPose_nms import pose_nms
 from alphapose.utils.config import update_config
 
+from producer.beta.gating import is_reuse_marker, split_markers
 from producer.beta.loader import QueueWorkProcessor, ResultTarget
-from producer.helpers import rabbit_params, packb, unpackb, columnarize, ObjectView, list_to_tensor
+from producer.beta.transforms import crop_boxes, heatmaps_to_coords
+from producer import framestore
+from producer.backends import EXECUTION_MODES, PRECISIONS, PoseBackend
+from producer.helpers import rabbit_params, unpackb, column_views, BatchAssembler, ObjectView
+from producer.redisclient import get_redis
+from producer.resultcache import get_result_cache
 # from producer.beta.ppose import pose_nms
 
 
 EVAL_JOINTS = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]
 
 
+def box_part(box):
+    """Result cache key part for a detected box, cached detections give the same box again."""
+    return ",".join(f"{value:.2f}" for value in box.tolist())
+
+
 class PoseEstimationWorker(QueueWorkProcessor):
 
-    def __init__(self, cfg, args, connection_params, source_queue_name, result_queue=None, batch_size=20, max_queue_size=4):
+    def __init__(self, cfg, args, connection_params, source_queue_name, result_queue=None, batch_size=20, max_queue_size=4,
+                 precision=None, execution=None):
         super().__init__(connection_params, source_queue_name, result_queue=result_queue, batch_size=batch_size, max_queue_size=max_queue_size)
         self.cfg = cfg
         self.args = args
@@ -31,7 +44,15 @@ class PoseEstimationWorker(QueueWorkProcessor):
         self.pose_dataset = builder.retrieve_dataset(cfg.DATASET.TRAIN)
         self.pose_model.to(args.device)
         self.pose_model.eval()
+        self.pose_backend = PoseBackend.from_settings(self.pose_model, cfg.DATA_PRESET.IMAGE_SIZE, args.checkpoint, device=args.device,
+                                                      precision=precision, execution=execution)
         self.heatmap_to_coord = get_func_heatmap_to_coord(cfg)
+        # heatmap models are decoded for the whole batch at once, regression heads box by box
+        self.batch_decoding = cfg.LOSS.get('TYPE') == 'MSELoss'
+        self._input_size = cfg.DATA_PRESET.IMAGE_SIZE
+        # boxes are cropped with `crop_boxes` as `SimpleTransform.test_transform` would
+        assert cfg.DATA_PRESET.TYPE == 'simple', "only the simple data preset is supported"
+        self.assembler = BatchAssembler(max_batch=batch_size)
 
     def prepare_single(self, message):
         decoded = unpackb(message)
@@ -40,73 +61,138 @@ class PoseEstimationWorker(QueueWorkProcessor):
     def process_batch(self, batch):
         norm_type = self.cfg.LOSS.get('NORM_TYPE', None)
         hm_size = self.cfg.DATA_PRESET.HEATMAP_SIZE
+        markers, batch = split_markers(batch)
+        if not batch:
+            return markers
+        redis_conn = get_redis()
+        records = self.image_records(redis_conn, [box["image_id"] for box in batch])
+        batch = [box for box in batch if box["image_id"] in records]
+        if not batch:
+            return markers
         results = []
-        columns = columnarize(batch, ["inp", "orig_img", "im_name", "box", "score", "id", "cropped_box", "date", "path", "assignment_id", "environment_id", "timestamp", "image_id", "box_id"])
-        inps = columns["inp"]
-        orig_img = columns["orig_img"]
-        im_name = columns["im_name"]
+        columns = column_views(batch, ["image_id", "box_id"])
         image_ids = columns["image_id"]
         box_ids = columns["box_id"]
-        boxes = columns["box"]
-        scores = columns["score"]
-        ids = columns["id"]
-        cropped_boxes = columns["cropped_box"]
-        date = columns["date"]
-        path = columns["path"]
-        assignment_id = columns["assignment_id"]
-        environment_id = columns["environment_id"]
-        timestamp = columns["timestamp"]
-
-        logging.info("processing batch: inps[%s] im_name[%s] boxes[%s]", len(inps), len(im_name), len(boxes))
-        boxes = list_to_tensor(boxes)
-        inps = list_to_tensor(inps)
-        scores = list_to_tensor(scores)
-        ids = list_to_tensor(ids)
+        images = [records[image_id] for image_id in image_ids]
+
+        logging.info("processing batch: boxes[%s] images[%s]", len(batch), len(records))
+        boxes = self.assembler.stack(batch, "box")
+        scores = self.assembler.stack(batch, "score")
+        ids = self.assembler.stack(batch, "id")
         with torch.no_grad():
-            inps = inps.to(self.args.device)
-            hm = self.pose_model(inps)
-            hm_data = hm.cpu()
-            if hm_data.size()[1] == 136:
-                eval_joints = [*range(0, 136)]
-            elif hm_data.size()[1] == 26:
-                eval_joints = [*range(0, 26)]
-            else:
-                eval_joints = EVAL_JOINTS
-            pose_coords = []
-            pose_scores = []
-            for i, bbox in enumerate(cropped_boxes):
-                bbox = bbox.tolist()
-                pose_coord, pose_score = self.heatmap_to_coord(hm_data[i][eval_joints], bbox, hm_shape=hm_size, norm_type=norm_type)
-                pose_coords.append(torch.from_numpy(pose_coord).unsqueeze(0))
-                pose_scores.append(torch.from_numpy(pose_score).unsqueeze(0))
-            preds_img = torch.cat(pose_coords)
-            preds_scores = torch.cat(pose_scores)
+            # boxes estimated before (the video is being processed again) come from the result cache
+            cache = get_result_cache()
+            cache_keys = [cache.key(image["path"], image["im_name"], self.pose_backend.model_id, box_part(box)) for image, box in zip(images, boxes)] if cache else []
+            cached = [cache.get(key) for key in cache_keys] if cache else [None] * len(boxes)
+            todo = [k for k, hit in enumerate(cached) if hit is None]
+            pose_coords = [hit and hit["keypoints"] for hit in cached]
+            pose_scores = [hit and hit["kp_score"] for hit in cached]
+            if todo:
+                # every frame of the batch is resolved once and all of its boxes are cropped at once
+                frame_ids = list(dict.fromkeys(image_ids[k] for k in todo))
+                frames = [framestore.resolve(records[image_id]["orig_img"]) for image_id in frame_ids]
+                image_index = [frame_ids.index(image_ids[k]) for k in todo]
+                inps, cropped_boxes = crop_boxes(frames, boxes[todo], image_index, self._input_size, device=self.args.device)
+                hm = self.pose_backend(inps.to(self.args.device))
+                hm_data = hm.cpu()
+                if hm_data.size()[1] == 136:
+                    eval_joints = [*range(0, 136)]
+                elif hm_data.size()[1] == 26:
+                    eval_joints = [*range(0, 26)]
+                else:
+                    eval_joints = EVAL_JOINTS
+                hm_data = hm_data[:, eval_joints]
+                if self.batch_decoding:
+                    coords, maxvals = heatmaps_to_coords(hm_data, cropped_boxes)
+                else:
+                    decoded = [self.heatmap_to_coord(hm_data[i], cropped_boxes[i].tolist(), hm_shape=hm_size, norm_type=norm_type) for i in range(len(todo))]
+                    coords = torch.stack([torch.from_numpy(pose_coord) for pose_coord, _ in decoded])
+                    maxvals = torch.stack([torch.from_numpy(pose_score) for _, pose_score in decoded])
+                for i, k in enumerate(todo):
+                    pose_coords[k] = coords[i]
+                    pose_scores[k] = maxvals[i]
+                    if cache:
+                        cache.put(cache_keys[k], {"keypoints": pose_coords[k], "kp_score": pose_scores[k]})
+            preds_img = torch.stack(pose_coords)
+            preds_scores = torch.stack(pose_scores)
+            proposal_scores = preds_scores.mean(dim=(1, 2))[:, None] + scores + 1.25 * preds_scores.amax(dim=(1, 2))[:, None]
             for k, points in enumerate(preds_img):
-                results.append(packb(
+                image = images[k]
+                results.append(
                     {
                         "image_id": image_ids[k],
                         "box_id": box_ids[k],
-                        "imgname": im_name[k],
+                        "imgname": image["im_name"],
                         'keypoints': points,
                         'kp_score': preds_scores[k],
                         "score": scores[k],
-                        'proposal_score': torch.mean(preds_scores[k]) + scores[k] + 1.25 * max(preds_scores[k]),
+                        'proposal_score': proposal_scores[k],
                         'idx': ids[k],
                         'bbox': boxes[k],
-                        "date": date[k],
-                        "path": path[k],
-                        "assignment_id": assignment_id[k],
-                        "environment_id": environment_id[k],
-                        "timestamp": timestamp[k],
+                        "date": image["date"],
+                        "path": image["path"],
+                        "assignment_id": image["assignment_id"],
+                        "environment_id": image["environment_id"],
+                        "timestamp": image["timestamp"],
                     }
-                ))
+                )
         logging.info("processing batch: results[%s]", len(results))
-        return results
+        return markers + results
+
+    @staticmethod
+    def image_records(redis_conn, image_ids):
+        """The image records (frame and metadata) the box tracker stored for `image_ids`, by image id."""
+        image_ids = list(dict.fromkeys(image_ids))
+        records = {}
+        for image_id, packed in zip(image_ids, redis_conn.mget([f"image.{image_id}" for image_id in image_ids])):
+            if packed is None:
+                logging.warning("image record %s is gone, its boxes were estimated before, dropping them", image_id)
+                continue
+            records[image_id] = unpackb(packed)
+        return records
+
+    def finish_batch(self, batch):
+        """
+        Marks the boxes of the batch as done once their poses are published, the frame of an image is
+        released and its record removed with its last box. Boxes are counted by id, a box that is
+        delivered again is not counted twice.
+        """
+        box_ids = defaultdict(list)
+        for box in batch:
+            if not is_reuse_marker(box):
+                box_ids[box["image_id"]].append(box["box_id"])
+        if not box_ids:
+            return
+        redis_conn = get_redis()
+        with redis_conn.pipeline(transaction=True) as pipe:
+            for image_id, ids in box_ids.items():
+                pipe.sadd(f"image.{image_id}.done", *ids)
+                pipe.scard(f"image.{image_id}.done")
+                pipe.get(f"image.{image_id}.boxes")
+            replies = pipe.execute()
+        finished = [image_id for k, image_id in enumerate(box_ids)
+                    if replies[3 * k + 2] is not None and replies[3 * k + 1] >= int(replies[3 * k + 2])]
+        # boxes delivered again after their image was finished leave a done set behind
+        stale = [image_id for k, image_id in enumerate(box_ids) if replies[3 * k + 2] is None]
+        if not finished and not stale:
+            return
+        # the record is read and removed at once, only one worker releases the frame
+        with redis_conn.pipeline(transaction=True) as pipe:
+            for image_id in finished:
+                pipe.get(f"image.{image_id}")
+            pipe.delete(*[f"image.{image_id}{suffix}" for image_id in finished for suffix in ("", ".boxes", ".done")],
+                        *[f"image.{image_id}.done" for image_id in stale])
+            packed_records = pipe.execute()[:-1]
+        for packed in packed_records:
+            if packed is not None:
+                framestore.release(unpackb(packed)["orig_img"])
 
 
 @click.command()
 @click.option('--device')
-def main(device="cpu"):
+@click.option('--precision', type=click.Choice(list(PRECISIONS)), default=None, help="pose model precision, POSE_PRECISION by default")
+@click.option('--execution', multiple=True, type=click.Choice(EXECUTION_MODES), help="pose model execution modes, POSE_EXECUTION by default")
+def main(device="cpu", precision=None, execution=()):
     gpus = []
     if device != "cpu":
         gpus = [int(device)]
@@ -128,8 +214,9 @@ def main(device="cpu"):
         "gpus": gpus,
     })
     cfg = update_config("/build/AlphaPose/data/pose_cfgs/wf_alphapose_inference_config.yaml")
-    worker = PoseEstimationWorker(cfg, args, rabbit_params(), 'estimator', result_queue=ResultTarget('poses', '2dpose'))
-    preloader, processor = worker.start()
+    worker = PoseEstimationWorker(cfg, args, rabbit_params(), 'estimator', result_queue=ResultTarget('poses', '2dpose'),
+                                  precision=precision, execution=execution or None)
+    worker.start()
     while not worker.stopped:
         time.sleep(5)
 
@@ -1,6 +1,6 @@
 """
 
-video ->  detection -> box-tracker -> estimator -> pose-tracker ---> pose-upload
+video -> (motion-gate) -> detection -> box-tracker -> estimator -> pose-tracker ---> pose-upload
                                                                  |-> pose-local
 
 """
@@ -9,6 +9,7 @@ video ->  detection -> box-tracker -> estimator -> pose-tracker ---> pose-upload
 
 EXCHANGES = [
     ("videos", "video", "extract-frames"),
+    ("images", "motion-gate", "gate"),
     ("images", "detection", "detector"),
     ("boxes", "estimator", "estimation"),
     ("boxes", "box-tracker", "catalog"),
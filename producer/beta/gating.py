@@ -0,0 +1,100 @@
+"""
+Motion gating between frame extraction and detection.
+
+Classroom cameras are static, `MotionGateWorker` compares a small grayscale copy of every frame with
+the last frame of the same video that went on to detection. Frames that changed less than
+`MOTION_GATE_THRESHOLD` (mean absolute difference in gray levels) are replaced by a reuse marker that
+names the reference frame. The marker passes through the later stages as it is and `savelocal` writes
+the reference frame's poses for it. At most `MOTION_GATE_MAX_SKIP` frames in a row are gated.
+"""
+from collections import OrderedDict
+import time
+
+import cv2
+import numpy as np
+
+from producer.beta.loader import QueueWorkProcessor, ResultTarget
+from producer import framestore
+from producer.helpers import rabbit_params, unpackb
+from producer import settings as s
+
+
+# frames are compared at this size, enough to see a person move and cheap to difference
+GATE_SIZE = (64, 36)
+# videos a gate keeps reference frames for
+MAX_REFERENCES = 256
+
+MARKER_FIELDS = ["im_name", "path", "date", "assignment_id", "environment_id", "timestamp"]
+
+
+def reuse_marker(frame, reference_im_name):
+    marker = {key: frame[key] for key in MARKER_FIELDS}
+    marker["reuse_im_name"] = reference_im_name
+    return marker
+
+
+def is_reuse_marker(item):
+    return isinstance(item, dict) and "reuse_im_name" in item
+
+
+def split_markers(batch):
+    """Returns the reuse markers and the other items of `batch`."""
+    markers = [item for item in batch if is_reuse_marker(item)]
+    if not markers:
+        return markers, batch
+    return markers, [item for item in batch if not is_reuse_marker(item)]
+
+
+class MotionGateWorker(QueueWorkProcessor):
+
+    def __init__(self, connection_params, source_queue_name, result_queue=None, batch_size=10, max_queue_size=10,
+                 threshold=None, max_skip=None):
+        # reference frames are kept in the processor, frames of a video have to pass through one gate in order
+        super().__init__(connection_params, source_queue_name, result_queue=result_queue, batch_size=batch_size,
+                         max_queue_size=max_queue_size, processors=1, preloaders=1)
+        self.threshold = s.MOTION_GATE_THRESHOLD if threshold is None else threshold
+        self.max_skip = s.MOTION_GATE_MAX_SKIP if max_skip is None else max_skip
+        # path -> (small grayscale frame, im_name, frames gated since)
+        self._references = OrderedDict()
+
+    def prepare_single(self, message):
+        return unpackb(message)
+
+    def process_batch(self, batch):
+        results = []
+        for frame in batch:
+            started = time.perf_counter()
+            small = self.downscale(framestore.resolve(frame["orig_img"]))
+            reference = self._references.get(frame["path"])
+            if reference is not None and reference[2] < self.max_skip and self.difference(small, reference[0]) < self.threshold:
+                self._references[frame["path"]] = (reference[0], reference[1], reference[2] + 1)
+                framestore.release(frame["orig_img"])
+                results.append(reuse_marker(frame, reference[1]))
+                self.metrics.observe("motion-gated", time.perf_counter() - started)
+                continue
+            self._references[frame["path"]] = (small, frame["im_name"], 0)
+            self._references.move_to_end(frame["path"])
+            if len(self._references) > MAX_REFERENCES:
+                self._references.popitem(last=False)
+            results.append(frame)
+            self.metrics.observe("motion-processed", time.perf_counter() - started)
+        return results
+
+    @staticmethod
+    def downscale(image):
+        image = np.ascontiguousarray(image)
+        if image.ndim == 3:
+            # channel order does not matter for a difference, the frames are RGB
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        return cv2.resize(image, GATE_SIZE, interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def difference(small, reference):
+        return float(cv2.absdiff(small, reference).mean())
+
+
+if __name__ == '__main__':
+    worker = MotionGateWorker(rabbit_params(), 'motion-gate', result_queue=ResultTarget('images', 'detector'))
+    worker.start()
+    while not worker.stopped:
+        time.sleep(5)
@@ -4,18 +4,20 @@ import logging
 import os
 import time
 from collections import namedtuple
-from uuid import UUID
+from uuid import UUID, uuid4
 
 import click
 import cv2
 import numpy as np
 import torch
-import redis
 from alphapose.utils.pPose_nms import pose_nms
 
+from producer.beta.gating import is_reuse_marker
 from producer.beta.loader import QueueWorkProcessor, ResultTarget
 from producer.beta.posemodel import PoseFrame, Pose2D, Keypoint, Box
-from producer.helpers import rabbit_params, now, packb, unpackb, columnarize, index_dicts, list_to_tensor
+from producer.helpers import rabbit_params, now, packb, unpackb, column_views, index_dicts, BatchAssembler
+from producer import settings as s
+from producer.redisclient import get_redis
 
 
 PoseWorkerOptions = namedtuple("PoseWorkerOptions", ["outputpattern", "format"])
@@ -26,6 +28,7 @@ class PoseWorker(QueueWorkProcessor):
         super().__init__(connection_params, source_queue_name, result_queue=result_queue, batch_size=batch_size, max_queue_size=max_queue_size)
         self.command = command
         self.opts = opts
+        self.assembler = BatchAssembler()
 
     def prepare_single(self, message):
         return unpackb(message)
@@ -42,47 +45,61 @@ class PoseWorker(QueueWorkProcessor):
 
     def rectify_poses(self, batch):
         result = []
-        redis_conn = redis.Redis(host="redis")
+        poses = [pose for pose in batch if not is_reuse_marker(pose)]
+        image_ids = list(dict.fromkeys(pose['image_id'] for pose in poses))
+        # the batch's poses are stored and the manifests of their images compared in one transaction
+        with get_redis().pipeline(transaction=True) as pipe:
+            for pose in poses:
+                pipe.sadd(f"poses.{pose['image_id']}.processed", pose['box_id'].encode('utf8'))
+                pipe.set(f"pose.{pose['image_id']}.{pose['box_id']}", packb(pose))
+            for image_id in image_ids:
+                pipe.smembers(f"input.{image_id}.manifest")
+                pipe.smembers(f"poses.{image_id}.processed")
+            replies = pipe.execute()[2 * len(poses):]
+        complete = {image_id for k, image_id in enumerate(image_ids) if replies[2 * k] == replies[2 * k + 1]}
         for pose in batch:
-            input_key = f"input.{pose['image_id']}.manifest"
-            pose_key = f"pose.{pose['image_id']}.{pose['box_id']}"
-            track_key = f"poses.{pose['image_id']}.processed"
-            redis_conn.sadd(track_key, pose['box_id'].encode('utf8'))
-            redis_conn.set(pose_key, packb(pose))
-            input_set = set(redis_conn.smembers(input_key))
-            processed_set = set(redis_conn.smembers(track_key))
-            if input_set == processed_set:
-                result.append(packb(pose['image_id']))
+            if is_reuse_marker(pose):
+                result.append(pose)
+            elif pose['image_id'] in complete:
+                # an image is forwarded once, with the first of its poses in the batch
+                result.append(pose['image_id'])
+                complete.discard(pose['image_id'])
         return result
 
     def deduplicate(self, batch):
         results = []
-        redis_conn = redis.Redis(host="redis")
-        for image_id in batch:
-            # 1) collect the poses from redis
-            input_key = f"input.{image_id}.manifest"
-            box_ids = redis_conn.smembers(input_key)
-            logging.info("`%s` found [[ %s ]]", input_key, box_ids)
+        redis_conn = get_redis()
+        # 1) collect the poses of the batch's images from redis, the manifests and then the poses in one round trip each
+        image_ids = [image_id for image_id in batch if not is_reuse_marker(image_id)]
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for image_id in image_ids:
+                pipe.smembers(f"input.{image_id}.manifest")
+            manifests = dict(zip(image_ids, pipe.execute()))
+        for image_id, box_ids in manifests.items():
+            logging.info("`input.%s.manifest` found [[ %s ]]", image_id, box_ids)
             if len(box_ids) == 0:
                 raise Exception("something is fucked")
-            poses = []
-            for box_id in box_ids:
-                key = f"pose.{image_id}.{box_id.decode('utf8')}"
-                logging.info("fetching %s from redis", key)
-                poses.append(unpackb(redis_conn.get(key)))
+        keys = [f"pose.{image_id}.{box_id.decode('utf8')}" for image_id in image_ids for box_id in manifests[image_id]]
+        packed_poses = iter(redis_conn.mget(keys) if keys else [])
+        for image_id in batch:
+            if is_reuse_marker(image_id):
+                # a frame the motion gate skipped, `savelocal` writes the reference frame's poses for it
+                results.append([image_id])
+                continue
+            poses = [unpackb(next(packed_poses)) for _ in manifests[image_id]]
             # 2) run pose_nms on poses
-            columns = columnarize(poses, ["bbox", "score", "box_id", "keypoints", "kp_score"])
+            columns = column_views(poses, ["box_id"])
             index = index_dicts(poses, "box_id")
             logging.info("ids before filter %s", index.keys())
             boxes, scores, ids, preds_img, preds_scores, pick_ids = \
                 pose_nms(
-                    list_to_tensor(columns["bbox"]),
-                    list_to_tensor(columns["score"]),
+                    self.assembler.stack(poses, "bbox"),
+                    self.assembler.stack(poses, "score"),
                     # pylint: disable=E1102
                     torch.tensor([UUID(box_id).bytes for box_id in columns["box_id"]], dtype=torch.uint8),
                     # pylint: enable=E1102
-                    list_to_tensor(columns['keypoints']),
-                    list_to_tensor(columns['kp_score']),
+                    self.assembler.stack(poses, "keypoints"),
+                    self.assembler.stack(poses, "kp_score"),
                     0)
             # 3) add result
             poses_clean = []
@@ -100,21 +117,24 @@ class PoseWorker(QueueWorkProcessor):
 
     def postprocess_batch(self, batch):
         if self.command == "deduplicate":
-            redis_conn = redis.Redis(host="redis")
+            keys = []
             for poses in batch:
-                if len(poses) > 0:
+                if len(poses) > 0 and not is_reuse_marker(poses[0]):
                     image_id = poses[0]["image_id"]
-                    redis_conn.delete(f"input.{image_id}.manifest")
-                    box_ids = [pose["box_id"] for pose in poses]
-                    redis_conn.delete(*[f"pose.{image_id}.{box_id}" for box_id in box_ids])
-                    redis_conn.delete(f"poses.{image_id}.processed")
-            return [packb(poses) for poses in batch]
+                    keys.append(f"input.{image_id}.manifest")
+                    keys.extend(f"pose.{image_id}.{pose['box_id']}" for pose in poses)
+                    keys.append(f"poses.{image_id}.processed")
+            if keys:
+                get_redis().delete(*keys)
         return batch
 
     def localcache(self, batch):
+        redis_conn = get_redis()
         for poses in batch:
-            if len(poses) > 0:
-                dirname = os.path.join(os.path.dirname(poses[0]["path"]), os.path.basename(poses[0]["path"]).split('.')[0])
+            if len(poses) > 0 and is_reuse_marker(poses[0]):
+                self.reuse_poses(redis_conn, poses[0])
+            elif len(poses) > 0:
+                dirname, output_path = self.localcache_path(poses[0]["path"], poses[0]["imgname"])
                 os.makedirs(dirname, exist_ok=True)
                 frame = PoseFrame(
                     image_id=poses[0]["image_id"],
@@ -138,13 +158,55 @@ class PoseWorker(QueueWorkProcessor):
                         box_id=pose["box_id"],
                         bbox=Box(*pose["bbox"]),
                     ))
-                frame_num = frame.image_name.split('.')[0]
                 # logging.info(dataclasses.asdict(frame))
-                with open(os.path.join(dirname, f"poses-{frame_num}.json"), 'w') as fp:
+                with open(output_path, 'w') as fp:
                     json.dump(dataclasses.asdict(frame), fp)
                     fp.flush()
+                self.resolve_pending(redis_conn, output_path)
         return []
 
+    @staticmethod
+    def localcache_path(video_path, image_name):
+        dirname = os.path.join(os.path.dirname(video_path), os.path.basename(video_path).split('.')[0])
+        frame_num = image_name.split('.')[0]
+        return dirname, os.path.join(dirname, f"poses-{frame_num}.json")
+
+    def reuse_poses(self, redis_conn, marker):
+        _, reference_path = self.localcache_path(marker["path"], marker["reuse_im_name"])
+        if os.path.exists(reference_path):
+            self.write_reused(reference_path, [marker])
+            return
+        # the reference frame's poses have not been written yet, they are written for the marker when
+        # they are. A reference without poses never is and the marker expires, as the frame had none.
+        key = f"reuse.{reference_path}"
+        with redis_conn.pipeline() as pipe:
+            pipe.rpush(key, packb(marker))
+            pipe.expire(key, s.MOTION_GATE_PENDING_TTL)
+            pipe.execute()
+        if os.path.exists(reference_path):
+            # written while the marker was being queued
+            self.resolve_pending(redis_conn, reference_path)
+
+    def resolve_pending(self, redis_conn, reference_path):
+        key = f"reuse.{reference_path}"
+        with redis_conn.pipeline() as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            pending, _ = pipe.execute()
+        if pending:
+            self.write_reused(reference_path, [unpackb(marker) for marker in pending])
+
+    def write_reused(self, reference_path, markers):
+        with open(reference_path, 'r') as fp:
+            reference = json.load(fp)
+        for marker in markers:
+            dirname, output_path = self.localcache_path(marker["path"], marker["im_name"])
+            os.makedirs(dirname, exist_ok=True)
+            frame = dict(reference, image_id=str(uuid4()), image_name=marker["im_name"], timestamp=marker["timestamp"])
+            with open(output_path, 'w') as fp:
+                json.dump(frame, fp)
+                fp.flush()
+
 
 @click.group()
 def main():
@@ -154,7 +216,7 @@ def main():
 @main.command()
 def rectify():
     worker = PoseWorker("rectify", None, rabbit_params(), 'pose-tracker', result_queue=ResultTarget('poses', 'imageid'))
-    preloader, processor = worker.start()
+    worker.start()
     while not worker.stopped:
         time.sleep(5)
 
@@ -162,7 +224,7 @@ def rectify():
 @main.command()
 def deduplicate():
     worker = PoseWorker("deduplicate", None, rabbit_params(), 'pose-deduplicate', result_queue=ResultTarget('poses', '2dposeset'), batch_size=4)
-    preloader, processor = worker.start()
+    worker.start()
     while not worker.stopped:
         time.sleep(5)
 
@@ -170,7 +232,7 @@ def deduplicate():
 @main.command()
 def savelocal():
     worker = PoseWorker("savelocal", None, rabbit_params(), 'pose-local', batch_size=10)
-    preloader, processor = worker.start()
+    worker.start()
     while not worker.stopped:
         time.sleep(5)
 
@@ -1,101 +1,380 @@
 import logging
 import os
+from queue import Empty, Full
+import signal
 import sys
 import time
 from collections import namedtuple
 
 import pika
+import torch
 import torch.multiprocessing as mp
 
 from producer.beta.exchanges import setup_exchanges
-from producer.metric import emit
+from producer.beta.publishing import ConfirmPublisher
+from producer.helpers import packb
+from producer.metric import StageMetrics
+from producer import settings as s
 
 
 ResultTarget = namedtuple('ResultTarget', ['exchange', 'routing_key'])
 
+# messages handed to the processor with the delivery tags to acknowledge once they are done,
+# `preloader` and `generation` identify the channel the tags belong to
+Batch = namedtuple('Batch', ['items', 'delivery_tags', 'generation', 'preloader'])
+
+MIN_POLL_WAIT = 0.1
+MAX_POLL_WAIT = 5
+ACK_INTERVAL = 0.1
+
+
+class TimedIterable:
+    """
+    Wraps the result of a stage and adds up the seconds spent producing its items, so stages that
+    return generators can be timed as they are consumed.
+    """
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.seconds = 0.0
+
+    @classmethod
+    def wrap(cls, result):
+        # lists were produced by the call itself, they are passed on as they are
+        return result if isinstance(result, (list, tuple)) else cls(result)
+
+    def __iter__(self):
+        iterator = iter(self.iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds += time.perf_counter() - started
+                return
+            self.seconds += time.perf_counter() - started
+            yield item
+
+
+class AdaptiveBatcher:
+    """
+    Sizes batches from the measured compute time per item. While the stage keeps up a batch holds as
+    many items as can be processed within `max_latency` seconds, once work backs up batches grow to
+    `max_batch_size` for throughput.
+    """
+
+    def __init__(self, min_batch_size, max_batch_size, max_latency, smoothing=0.2):
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.smoothing = smoothing
+        # shared between the processors that measure and the preloaders that build batches
+        self.item_seconds = mp.Value('d', 0.0)
+
+    def record(self, items, seconds):
+        if items <= 0:
+            return
+        sample = seconds / items
+        with self.item_seconds.get_lock():
+            current = self.item_seconds.value
+            self.item_seconds.value = sample if current == 0 else current + self.smoothing * (sample - current)
+
+    def batch_size(self, backlog):
+        if backlog >= self.max_batch_size:
+            return self.max_batch_size
+        item_seconds = self.item_seconds.value
+        if item_seconds <= 0:
+            return self.max_batch_size
+        return max(self.min_batch_size, min(self.max_batch_size, int(self.max_latency / item_seconds)))
+
 
 class QueueWorkProcessor:
 
-    def __init__(self, connection_params, source_queue_name, result_queue=None, batch_size=10, max_queue_size=10):
+    def __init__(self, connection_params, source_queue_name, result_queue=None, batch_size=10, max_queue_size=10,
+                 prefetch_count=None, batch_timeout=None, consume_mode=None, processors=None, preloaders=None,
+                 min_batch_size=1, max_latency=None):
         self.connection_params = connection_params
         self.batch_size = batch_size
         self.max_queue_size = max_queue_size
         self.source_queue_name = source_queue_name
         self.result_queue = result_queue
+        self.batch_timeout = s.BATCH_TIMEOUT if batch_timeout is None else batch_timeout
+        self.consume_mode = consume_mode or s.CONSUME_MODE
+        self.processors = processors or s.PROCESSORS
+        # messages stay unacknowledged until their results are published, the window has to cover
+        # every batch waiting on the processor queue, the ones the processors hold and the one being filled
+        self.prefetch_count = max(prefetch_count or s.PREFETCH_COUNT, batch_size * (max_queue_size + self.processors + 1))
+        self.preloaders = preloaders or s.PRELOADERS
         mp.set_start_method('spawn')
+        max_latency = s.MAX_BATCH_LATENCY if max_latency is None else max_latency
+        # `batch_size` is the upper bound when batches are sized adaptively
+        self.batcher = AdaptiveBatcher(min(min_batch_size, batch_size), batch_size, max_latency) if max_latency > 0 else None
         self.queue = mp.Queue(maxsize=self.max_queue_size)
-        self._stopped = False
+        # one queue per preloader, delivery tags can only be acknowledged on the channel that received them
+        self.ack_queues = [mp.Queue() for _ in range(self.preloaders)]
+        self._stop_event = mp.Event()
+        self._workers = []
+        self._preloader_index = 0
+        self._finished_processors = 0
+        self.metrics = StageMetrics('QueueWorkProcessor-stages', {"class": self.__class__.__name__}, interval=s.METRICS_INTERVAL)
 
-    def preloader(self):
-        connection = pika.BlockingConnection(self.connection_params)
-        channel = connection.channel()
-        setup_exchanges(channel)
-        while True:
-            wait_time = 2
+    def __getstate__(self):
+        # started processes cannot be pickled into the next spawned worker
+        state = self.__dict__.copy()
+        state['_workers'] = []
+        return state
+
+    def preloader(self, index=0):
+        self._preloader_index = index
+        generation = 0
+        while not self._stop_event.is_set():
+            generation += 1
+            try:
+                connection = pika.BlockingConnection(self.connection_params)
+                channel = connection.channel()
+                setup_exchanges(channel)
+                unacked = {}
+                if self.consume_mode == "poll":
+                    self.poll_preloader(connection, channel, generation, unacked)
+                else:
+                    self.push_preloader(connection, channel, generation, unacked)
+                self.drain_acks(connection, channel, generation, unacked)
+                connection.close()
+            except pika.exceptions.AMQPError as err:
+                logging.warning("consumer connection lost, reconnecting [%s]", str(err))
+                time.sleep(1)
+        self.metrics.report(force=True)
+
+    def push_preloader(self, connection, channel, generation, unacked):
+        """
+        Fills batches from a `basic_consume` subscription. RabbitMQ pushes up to `prefetch_count`
+        unacknowledged messages, a batch is handed to the processor once it holds `batch_size`
+        messages or `batch_timeout` seconds after its first message arrived.
+        """
+        channel.basic_qos(prefetch_count=self.prefetch_count)
+        deliveries = []
+
+        def on_message(channel, method, properties, body):
+            try:
+                deliveries.append((method.delivery_tag, self.deserialize(body)))
+                unacked[method.delivery_tag] = method.redelivered
+            except Exception as err:
+                logging.exception("dropping message that could not be prepared [%s]", str(err))
+                channel.basic_nack(method.delivery_tag, requeue=False)
+
+        consumer_tag = channel.basic_consume(self.source_queue_name, on_message)
+        deadline = None
+        while not self._stop_event.is_set():
+            self.settle_acks(channel, generation, unacked)
+            self.metrics.report()
+            if deliveries and deadline is None:
+                deadline = time.monotonic() + self.batch_timeout
+            batch_size = self.target_batch_size(len(deliveries))
+            if deliveries and (len(deliveries) >= batch_size or time.monotonic() >= deadline):
+                batch = deliveries[:batch_size]
+                del deliveries[:batch_size]
+                deadline = None
+                logging.info("sending batch")
+                self.put_batch(connection, channel, generation, unacked, batch)
+                continue
+            # wake up regularly to pass acknowledgements from the processor on to the broker
+            time_limit = ACK_INTERVAL if deadline is None else min(max(deadline - time.monotonic(), 0), ACK_INTERVAL)
+            connection.process_data_events(time_limit=time_limit)
+        channel.basic_cancel(consumer_tag)
+
+    def poll_preloader(self, connection, channel, generation, unacked):
+        wait_time = MIN_POLL_WAIT
+        while not self._stop_event.is_set():
             batch = []
-            while len(batch) < self.batch_size:
-                if not connection.is_open:
-                    logging.info("reconnecting")
-                    connection = pika.BlockingConnection(self.connection_params)
-                    channel = connection.channel()
-                try:
-                    method_frame, header_frame, body = channel.basic_get(self.source_queue_name, auto_ack=True)
-                    if method_frame:
-                        thing = self.prepare_single(body)
-                        batch.append(thing)
-                    elif len(batch) > 0:
-                        break
-                except pika.exceptions.ConnectionBlockedTimeout as e:
-                    logging.info("timeout")
-                    if len(batch) > 0:
-                        break
-                    time.sleep(wait_time)
-                    wait_time *= wait_time
-            logging.info("sending batch")
-            self.queue.put(batch)
+            backlog = 0
+            while len(batch) < self.target_batch_size(len(batch) + backlog) and not self._stop_event.is_set():
+                self.settle_acks(channel, generation, unacked)
+                self.metrics.report()
+                method_frame, header_frame, body = channel.basic_get(self.source_queue_name, auto_ack=False)
+                if method_frame:
+                    backlog = method_frame.message_count
+                    try:
+                        batch.append((method_frame.delivery_tag, self.deserialize(body)))
+                        unacked[method_frame.delivery_tag] = method_frame.redelivered
+                    except Exception as err:
+                        logging.exception("dropping message that could not be prepared [%s]", str(err))
+                        channel.basic_nack(method_frame.delivery_tag, requeue=False)
+                    wait_time = MIN_POLL_WAIT
+                elif len(batch) > 0:
+                    break
+                else:
+                    # nothing queued, back off instead of spinning on basic_get
+                    connection.sleep(wait_time)
+                    wait_time = min(wait_time * 2, MAX_POLL_WAIT)
+            if batch:
+                logging.info("sending batch")
+                self.put_batch(connection, channel, generation, unacked, batch)
+
+    def target_batch_size(self, backlog):
+        """Size of the next batch given `backlog` messages waiting in the preloader."""
+        if self.batcher is None:
+            return self.batch_size
+        # batches already waiting on the processor mean the stage is behind
+        return self.batcher.batch_size(backlog + self.queue.qsize() * self.batch_size)
+
+    def put_batch(self, connection, channel, generation, unacked, deliveries):
+        batch = Batch(
+            items=[item for _, item in deliveries],
+            delivery_tags=[tag for tag, _ in deliveries],
+            generation=generation,
+            preloader=self._preloader_index,
+        )
+        while not self._stop_event.is_set():
+            try:
+                self.queue.put(batch, timeout=ACK_INTERVAL)
+                return
+            except Full:
+                # keep the connection serviced (heartbeats, acks) while the processor catches up
+                self.settle_acks(channel, generation, unacked)
+                connection.process_data_events(time_limit=0)
+
+    def settle_acks(self, channel, generation, unacked):
+        """
+        Acknowledges the batches the processor finished with. Failed batches are requeued once,
+        messages that were already redelivered are dropped so a poison message cannot loop.
+        """
+        ack_queue = self.ack_queues[self._preloader_index]
+        while True:
+            try:
+                outcome = ack_queue.get_nowait()
+            except Empty:
+                return
+            if outcome is None:
+                self._finished_processors += 1
+                continue
+            batch_generation, delivery_tags, success = outcome
+            if batch_generation != generation:
+                # delivery tags belong to a channel that is gone, the broker has requeued those messages
+                continue
+            for tag in delivery_tags:
+                redelivered = unacked.pop(tag, False)
+                if success:
+                    channel.basic_ack(tag)
+                else:
+                    channel.basic_nack(tag, requeue=not redelivered)
+
+    def drain_acks(self, connection, channel, generation, unacked):
+        """Passes acknowledgements on until every processor has exited so finished batches are not redelivered."""
+        deadline = time.monotonic() + s.SHUTDOWN_TIMEOUT
+        while self._finished_processors < self.processors and time.monotonic() < deadline:
+            self.settle_acks(channel, generation, unacked)
+            connection.process_data_events(time_limit=ACK_INTERVAL)
+
+    def deserialize(self, body):
+        started = time.perf_counter()
+        item = self.prepare_single(body)
+        self.metrics.observe("deserialize", time.perf_counter() - started)
+        return item
 
     def prepare_single(self, message):
         raise NotImplementedError("`prepare_single` has not been implemented, `QueueLoader` must be extended for purpose.")
 
     def processor(self):
+        if self.processors > 1:
+            # replicas share the node's cores instead of each running a thread per core
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // self.processors))
+        publisher = None
         if self.result_queue:
             connection = pika.BlockingConnection(self.connection_params)
-            channel = connection.channel()
-            setup_exchanges(channel)
-        while True:
-            batch = self.queue.get()
-            wait_time = 2
-            while batch:
+            setup_exchanges(connection.channel())
+            connection.close()
+            publisher = ConfirmPublisher(self.connection_params, window=s.PUBLISH_WINDOW, max_attempts=s.PUBLISH_MAX_ATTEMPTS).start()
+        try:
+            waiting = time.perf_counter()
+            while not self._stop_event.is_set():
+                self.metrics.report()
                 try:
-                    logging.info("starting batch [%s] (%s)", len(batch), self.__class__.__name__)
-                    emit('QueueWorkProcessor-stats', {"batch_size": len("batch"), }, {"class":  self.__class__.__name__, "type": "batch-start"})
-                    result = self.process_batch(batch)
-                    logging.info("finished batch [%s] (%s)", len(result), self.__class__.__name__)
-                    result = self.postprocess_batch(result)
-                    emit('QueueWorkProcessor-stats', {"result_size": len("result"), }, {"class":  self.__class__.__name__, "type": "batch-complete"})
-                    if len(result) > 0 and self.result_queue:
-                        exchange, routing_key = self.result_queue
-                        for item in result:
-                            logging.info("publishing result item(%s)", (item is not None))
-                            while item:
-                                if not connection.is_open:
-                                    logging.info("reconnecting")
-                                    connection = pika.BlockingConnection(self.connection_params)
-                                    channel = connection.channel()
-                                try:
-                                    channel.basic_publish(exchange, routing_key, item)
-                                    break
-                                except pika.exceptions.ConnectionBlockedTimeout as e:
-                                    logging.info("timeout")
-                                    time.sleep(wait_time)
-                                    wait_time *= wait_time
-                    del batch
-                    batch = None
-                except Exception as err:
-                    # TODO - log the batch so it can be recovered later
-                    logging.exception("failed to process [%s]", str(err))
-                    del batch
-                    batch = None
+                    batch = self.queue.get(timeout=ACK_INTERVAL)
+                except Empty:
+                    continue
+                self.metrics.observe("dequeue", time.perf_counter() - waiting, len(batch.items))
+                self.run_batch(publisher, batch)
+                del batch
+                waiting = time.perf_counter()
+        finally:
+            self.metrics.report(force=True)
+            if publisher:
+                publisher.close()
+            for ack_queue in self.ack_queues:
+                ack_queue.put(None)
+
+    def run_batch(self, publisher, batch):
+        ack_queue = self.ack_queues[batch.preloader]
+        try:
+            logging.info("starting batch [%s] (%s)", len(batch.items), self.__class__.__name__)
+            # either stage may return a generator, results are then published as they are produced and
+            # the time spent producing them is only known once they have been consumed
+            started = time.perf_counter()
+            processed = TimedIterable.wrap(self.process_batch(batch.items))
+            process_call = time.perf_counter() - started
+            started = time.perf_counter()
+            postprocessed = TimedIterable.wrap(self.postprocess_batch(processed))
+            postprocess_call = time.perf_counter() - started
+            count = self.publish_results(publisher, postprocessed)
+            process_lazy = getattr(processed, "seconds", 0.0)
+            process_seconds = process_call + process_lazy
+            postprocess_seconds = postprocess_call + getattr(postprocessed, "seconds", 0.0) - process_lazy
+            self.metrics.observe("process", process_seconds, len(batch.items))
+            self.metrics.observe("postprocess", postprocess_seconds, count)
+            logging.info("finished batch [%s] (%s)", count, self.__class__.__name__)
+            if self.batcher:
+                self.batcher.record(len(batch.items), process_seconds + postprocess_seconds)
+            # the source messages are acknowledged only once every result has been confirmed
+            ack_queue.put((batch.generation, batch.delivery_tags, True))
+        except Exception as err:
+            logging.exception("failed to process [%s]", str(err))
+            ack_queue.put((batch.generation, batch.delivery_tags, False))
+            return
+        try:
+            self.finish_batch(batch.items)
+        except Exception as err:
+            # the results are out, the batch is not retried for its clean up
+            logging.exception("failed to finish batch [%s]", str(err))
+
+    def publish_results(self, publisher, result):
+        """
+        Serializes and publishes the items of `result` as it is iterated. A generator is only advanced
+        while the publish window has room, so at most `PUBLISH_WINDOW` results are held in memory.
+        Returns the number of results.
+        """
+        exchange, routing_key = self.result_queue or (None, None)
+        count = 0
+        published = 0
+        serialize_seconds = 0.0
+        publish_seconds = 0.0
+        for item in result:
+            count += 1
+            if item is None or publisher is None:
+                continue
+            started = time.perf_counter()
+            message = self.serialize_result(item)
+            serialize_seconds += time.perf_counter() - started
+            if not message:
+                continue
+            started = time.perf_counter()
+            publisher.publish(exchange, routing_key, message, timeout=s.PUBLISH_TIMEOUT)
+            publish_seconds += time.perf_counter() - started
+            published += 1
+        if published:
+            started = time.perf_counter()
+            publisher.flush(timeout=s.PUBLISH_TIMEOUT)
+            publish_seconds += time.perf_counter() - started
+            self.metrics.observe("serialize", serialize_seconds, published)
+            self.metrics.observe("publish", publish_seconds, published)
+            for latency in publisher.take_latencies():
+                self.metrics.observe("confirm", latency)
+        return count
+
+    def serialize_result(self, item):
+        """Message body for a result, results that are not already bytes are packed with `packb`."""
+        if isinstance(item, (bytes, bytearray)):
+            return item
+        return packb(item)
 
     def process_batch(self, batch):
         raise NotImplementedError("`process_batch` has not been implemented, `QueueLoader` must be extended for purpose.")
@@ -103,31 +382,53 @@ class QueueWorkProcessor:
     def postprocess_batch(self, batch):
         return batch
 
+    def finish_batch(self, batch):
+        """
+        Runs once the results of `batch` have been confirmed and its messages acknowledged, for clean up
+        of state the messages reference that a failed batch, delivered again, still needs.
+        """
+
 
     def start(self):
-        return (
-            self.start_worker(self.preloader),
-            self.start_worker(self.processor),
-        )
+        self._workers = [self.start_worker(self.preloader, index) for index in range(self.preloaders)]
+        self._workers += [self.start_worker(self.processor) for _ in range(self.processors)]
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: self.stop())
+        return self._workers
 
-    def start_worker(self, target):
-        p = mp.Process(target=target)
+    def start_worker(self, target, *args):
+        p = mp.Process(target=self.run_worker, args=(target.__name__, *args))
         p.start()
         return p
 
+    def run_worker(self, name, *args):
+        # the parent handles ctrl-c and shuts the workers down in order
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        getattr(self, name)(*args)
+
     @property
     def stopped(self):
-        return self._stopped
+        if not self._stop_event.is_set() and any(not worker.is_alive() for worker in self._workers):
+            logging.error("a worker process exited, stopping (%s)", self.__class__.__name__)
+            self.stop()
+        return self._stop_event.is_set()
 
-    def stop(self):
-        # clear queues
-        self._stopped = True
+    def stop(self, timeout=None):
+        """
+        Stops consuming, lets the processors finish the batch in hand and waits for the preloaders to
+        acknowledge it. Batches still on the queue are requeued by the broker when the preloaders disconnect.
+        """
+        self._stop_event.set()
+        deadline = time.monotonic() + (s.SHUTDOWN_TIMEOUT if timeout is None else timeout)
+        for worker in self._workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
         self.clear_queue()
-        self._stopped = True
 
     def terminate(self):
-        self._stopped.value = True
-        self.stop()
+        self.stop(timeout=0)
 
     def clear_queue(self):
         while not self.queue.empty():
@@ -0,0 +1,173 @@
+"""
+Asynchronous result publishing with publisher confirms for `QueueWorkProcessor`.
+
+The processor hands messages to `ConfirmPublisher.publish`, which only blocks while `window` messages
+are waiting on a confirm. A `pika.SelectConnection` running in a background thread publishes them and
+tracks the confirms, messages the broker nacks are published again and messages lost with the
+connection are sent on the next one. `flush` waits for the outstanding confirms at the end of a batch.
+"""
+import collections
+import logging
+import threading
+import time
+
+import pika
+
+
+class PublishError(Exception):
+    pass
+
+
+class _Message:
+    __slots__ = ("exchange", "routing_key", "body", "attempts", "published_at")
+
+    def __init__(self, exchange, routing_key, body):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.attempts = 0
+        self.published_at = None
+
+
+class ConfirmPublisher:
+
+    def __init__(self, connection_params, window=256, max_attempts=5, reconnect_delay=5):
+        self.connection_params = connection_params
+        self.window = window
+        self.max_attempts = max_attempts
+        self.reconnect_delay = reconnect_delay
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self._condition = threading.Condition()
+        self._outbox = collections.deque()
+        self._pending = {}
+        self._failed = []
+        self._latencies = []
+        self._delivery_tag = 0
+        self._connection = None
+        self._channel = None
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="confirm-publisher", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopping:
+            self._connection = pika.SelectConnection(
+                self.connection_params,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_open_error,
+                on_close_callback=self._on_connection_closed)
+            # returns once the connection is closed
+            self._connection.ioloop.start()
+            if not self._stopping:
+                time.sleep(self.reconnect_delay)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, err):
+        logging.warning("publisher connection failed, retrying in %ss [%s]", self.reconnect_delay, err)
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        with self._condition:
+            self._channel = None
+            # unconfirmed messages may or may not have been routed, send them again in their original order
+            self._outbox.extendleft(self._pending[tag] for tag in sorted(self._pending, reverse=True))
+            self._pending.clear()
+        if not self._stopping:
+            logging.warning("publisher connection closed, reconnecting in %ss [%s]", self.reconnect_delay, reason)
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(
+            ack_nack_callback=self._on_delivery_confirmation,
+            callback=lambda _frame: self._on_confirm_selected(channel))
+
+    def _on_channel_closed(self, channel, reason):
+        logging.warning("publisher channel %s closed [%s]", channel, reason)
+        self._close_connection()
+
+    def _on_confirm_selected(self, channel):
+        with self._condition:
+            self._channel = channel
+            self._delivery_tag = 0
+        self._drain()
+
+    def _drain(self):
+        with self._condition:
+            while self._outbox and self._channel is not None and self._channel.is_open:
+                message = self._outbox.popleft()
+                self._channel.basic_publish(message.exchange, message.routing_key, message.body)
+                self._delivery_tag += 1
+                message.published_at = time.monotonic()
+                self._pending[self._delivery_tag] = message
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        with self._condition:
+            if method.multiple:
+                tags = [tag for tag in self._pending if tag <= method.delivery_tag]
+            else:
+                tags = [method.delivery_tag] if method.delivery_tag in self._pending else []
+            now = time.monotonic()
+            for tag in tags:
+                message = self._pending.pop(tag)
+                if acked:
+                    self.confirmed += 1
+                    self._latencies.append(now - message.published_at)
+                    continue
+                self.nacked += 1
+                message.attempts += 1
+                if message.attempts >= self.max_attempts:
+                    self._failed.append(message)
+                else:
+                    self._outbox.append(message)
+            self._condition.notify_all()
+        if not acked:
+            self._drain()
+
+    def publish(self, exchange, routing_key, body, timeout=None):
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self._outbox) + len(self._pending) < self.window, timeout):
+                raise PublishError("timed out waiting for room in the publish window")
+            self._outbox.append(_Message(exchange, routing_key, body))
+            self.published += 1
+            connection = self._connection
+        if connection is not None and connection.is_open:
+            connection.ioloop.add_callback_threadsafe(self._drain)
+
+    def flush(self, timeout=None):
+        """Waits for every published message to be confirmed, raises if any was nacked `max_attempts` times."""
+        with self._condition:
+            confirmed = self._condition.wait_for(lambda: not self._outbox and not self._pending, timeout)
+            failed, self._failed = self._failed, []
+        if not confirmed:
+            raise PublishError("timed out waiting for publisher confirms")
+        if failed:
+            raise PublishError(f"{len(failed)} messages were rejected by the broker")
+
+    def take_latencies(self):
+        """Returns the publish-to-confirm latencies (seconds) recorded since the last call."""
+        with self._condition:
+            latencies, self._latencies = self._latencies, []
+        return latencies
+
+    def _close_connection(self):
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def close(self, timeout=10):
+        self._stopping = True
+        connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(self._close_connection)
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,119 @@
+"""
+Per-assignment regions of interest and box filters for `ImageDetectionWorker`.
+
+`REGIONS_CONFIG` names a JSON file with a `default` entry and entries per assignment id, an
+assignment's entry overrides the default field by field:
+
+    {
+        "default": {"min_area": 2000, "min_score": 0.2, "max_boxes": 30},
+        "<assignment_id>": {
+            "roi": [[[0, 300], [1920, 300], [1920, 1080], [0, 1080]]],
+            "min_aspect": 0.2,
+            "max_aspect": 1.5
+        }
+    }
+
+    roi                     polygons in frame pixels, boxes are kept when their center is inside one
+    min_area, max_area      box area in frame pixels
+    min_aspect, max_aspect  box width / height
+    min_score               detector score
+    max_boxes               boxes kept per frame, the highest scoring ones
+
+Every box that is dropped here is a pose model forward pass saved. With a `roi` the detector is run on
+the polygons' bounding rectangle instead of the whole frame when the rectangle is smaller.
+"""
+import json
+import logging
+
+import numpy as np
+import torch
+
+
+FIELDS = ("roi", "min_area", "max_area", "min_aspect", "max_aspect", "min_score", "max_boxes")
+
+
+def points_in_polygon(points, polygon):
+    """Even-odd rule for N x 2 `points` and an M x 2 `polygon`."""
+    x, y = points[:, 0:1], points[:, 1:2]
+    x0, y0 = polygon[:, 0], polygon[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    spans = (y0 > y) != (y1 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing_x = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+    return (spans & (x < crossing_x)).sum(axis=1) % 2 == 1
+
+
+class RegionFilter:
+
+    def __init__(self, roi=None, min_area=None, max_area=None, min_aspect=None, max_aspect=None, min_score=None, max_boxes=None):
+        self.roi = [np.asarray(polygon, dtype=np.float64) for polygon in roi or []]
+        self.min_area = min_area
+        self.max_area = max_area
+        self.min_aspect = min_aspect
+        self.max_aspect = max_aspect
+        self.min_score = min_score
+        self.max_boxes = max_boxes
+
+    def window(self, width, height):
+        """`x0, y0, x1, y1` of the region to detect in, None when that is the whole frame."""
+        if not self.roi:
+            return None
+        points = np.concatenate(self.roi)
+        x0, y0 = np.floor(points.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(points.max(axis=0)).astype(int)
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+        if x1 <= x0 or y1 <= y0 or (x1 - x0) * (y1 - y0) >= width * height:
+            return None
+        return x0, y0, x1, y1
+
+    def keep(self, boxes, scores):
+        """Mask of the `x1, y1, x2, y2` boxes (with their `scores`) of one frame that pass the filter."""
+        w = boxes[:, 2] - boxes[:, 0]
+        h = boxes[:, 3] - boxes[:, 1]
+        keep = torch.ones(len(boxes), dtype=torch.bool)
+        if self.min_area is not None:
+            keep &= w * h >= self.min_area
+        if self.max_area is not None:
+            keep &= w * h <= self.max_area
+        if self.min_aspect is not None:
+            keep &= w >= self.min_aspect * h
+        if self.max_aspect is not None:
+            keep &= w <= self.max_aspect * h
+        if self.min_score is not None:
+            keep &= scores >= self.min_score
+        if self.roi:
+            centers = ((boxes[:, :2] + boxes[:, 2:]) / 2).numpy().astype(np.float64)
+            inside = np.zeros(len(boxes), dtype=bool)
+            for polygon in self.roi:
+                inside |= points_in_polygon(centers, polygon)
+            keep &= torch.from_numpy(inside)
+        if self.max_boxes is not None and int(keep.sum()) > self.max_boxes:
+            ranked = torch.where(keep, scores, torch.full_like(scores, -float("inf"))).argsort(descending=True)
+            keep = torch.zeros_like(keep)
+            keep[ranked[:self.max_boxes]] = True
+        return keep
+
+
+class RegionFilters:
+
+    def __init__(self, config=None):
+        config = dict(config or {})
+        self.default = config.pop("default", {})
+        unknown = {field for entry in [self.default, *config.values()] for field in entry} - set(FIELDS)
+        if unknown:
+            raise ValueError(f"unknown region filter fields {sorted(unknown)}, expected some of {FIELDS}")
+        self._filters = {assignment_id: RegionFilter(**{**self.default, **entry}) for assignment_id, entry in config.items()}
+        self._default = RegionFilter(**self.default) if self.default else None
+
+    @classmethod
+    def load(cls, path):
+        if not path:
+            return cls()
+        with open(path, 'r') as handle:
+            config = json.load(handle)
+        logging.info("loaded region filters for %s assignments from %s", len(config) - ("default" in config), path)
+        return cls(config)
+
+    def get(self, assignment_id):
+        """The filter of `assignment_id`, None when boxes are not filtered."""
+        return self._filters.get(assignment_id, self._default)
@@ -0,0 +1,188 @@
+"""
+Batched versions of the image transforms of the detection stage.
+
+`letterbox_batch` is the YOLO detector's `prep_frame` for a batch of frames, each frame is resized
+into a preallocated canvas and the batch is converted to a float tensor at once.
+
+`crop_boxes` computes the affine transforms of every box of every image in a batch at once, warps
+the crops into one buffer and normalizes them in a single pass, instead of running
+`SimpleTransform.test_transform` and copying its result box by box. It follows `test_transform`:
+the box is grown to the input aspect ratio and by 1.25, warped with bilinear interpolation and a
+black border, scaled to [0, 1] and the channel means are removed.
+
+`heatmaps_to_coords` decodes the pose model's heatmaps of a whole batch back into frame coordinates,
+as `heatmap_to_coord_simple` does for the heatmaps of one box.
+
+On the CPU the crops are warped with `cv2.warpAffine` into a shared uint8 buffer, each frame is made
+contiguous once rather than by every warp of a flipped RGB view. On a GPU the frames are uploaded and
+all crops of a frame size are sampled with one `grid_sample`. Both match the per box path to within
+one gray level.
+"""
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+# channel means `SimpleTransform.test_transform` subtracts
+PIXEL_MEANS = (0.406, 0.457, 0.480)
+
+
+def letterbox_batch(images, inp_dim):
+    """
+    Resizes H x W x 3 RGB frames (bicubic, aspect ratio kept) into the middle of gray `inp_dim`
+    squares, returns them as an N x 3 x inp_dim x inp_dim batch scaled to [0, 1].
+    """
+    canvas = np.full((len(images), inp_dim, inp_dim, 3), 128, dtype=np.uint8)
+    for i, image in enumerate(images):
+        img_h, img_w = image.shape[:2]
+        ratio = min(inp_dim / img_w, inp_dim / img_h)
+        new_w, new_h = int(img_w * ratio), int(img_h * ratio)
+        top, left = (inp_dim - new_h) // 2, (inp_dim - new_w) // 2
+        canvas[i, top:top + new_h, left:left + new_w] = cv2.resize(np.ascontiguousarray(image), (new_w, new_h), interpolation=cv2.INTER_CUBIC)
+    imgs = torch.empty(len(images), 3, inp_dim, inp_dim)
+    imgs.copy_(torch.from_numpy(canvas).permute(0, 3, 1, 2))
+    return imgs.div_(255.0)
+
+
+def box_to_center_scale(boxes, aspect_ratio, scale_mult=1.25):
+    """Centers and scales (w, h) of `xmin, ymin, xmax, ymax` boxes grown to `aspect_ratio` (w / h)."""
+    boxes = boxes.float()
+    w = boxes[:, 2] - boxes[:, 0]
+    h = boxes[:, 3] - boxes[:, 1]
+    center = torch.stack([boxes[:, 0] + w * 0.5, boxes[:, 1] + h * 0.5], dim=1)
+    wider = w > aspect_ratio * h
+    scale = torch.stack([torch.where(wider, w, h * aspect_ratio), torch.where(wider, w / aspect_ratio, h)], dim=1)
+    return center, scale * scale_mult
+
+
+def center_scale_to_box(center, scale):
+    xy_min = center - scale * 0.5
+    return torch.cat([xy_min, xy_min + scale], dim=1)
+
+
+def affine_transforms(center, scale, input_size):
+    """
+    `get_affine_transform(center, scale, 0, input size)` for every box as an N x 2 x 3 array. With no
+    rotation it is a uniform scale by `input width / scale width` about the box center.
+    """
+    inp_h, inp_w = input_size
+    center = center.double().numpy()
+    ratio = inp_w / scale[:, 0].double().numpy()
+    transforms = np.zeros((len(center), 2, 3))
+    transforms[:, 0, 0] = ratio
+    transforms[:, 1, 1] = ratio
+    transforms[:, 0, 2] = inp_w * 0.5 - ratio * center[:, 0]
+    transforms[:, 1, 2] = inp_h * 0.5 - ratio * center[:, 1]
+    return transforms
+
+
+def normalize(crops):
+    """N x H x W x C uint8 crops to the pose model's input, as `im_to_torch` and the mean subtraction."""
+    inps = torch.empty(crops.shape[0], crops.shape[3], crops.shape[1], crops.shape[2])
+    inps.copy_(torch.from_numpy(crops).permute(0, 3, 1, 2))
+    return _rescale(inps, torch.from_numpy(crops.reshape(crops.shape[0], -1).max(axis=1)))
+
+
+def _rescale(inps, peaks):
+    # `im_to_torch` only rescales crops that are not already in [0, 1]
+    factors = torch.where(peaks.float() > 1, 1 / 255, 1.0).to(inps.dtype)
+    inps.mul_(factors[:, None, None, None])
+    channels = min(inps.shape[1], len(PIXEL_MEANS))
+    inps[:, :channels] -= torch.tensor(PIXEL_MEANS[:channels], device=inps.device)[:, None, None]
+    return inps
+
+
+def warp_crops(images, transforms, image_index, input_size):
+    inp_h, inp_w = input_size
+    crops = np.empty((len(transforms), inp_h, inp_w, images[0].shape[2]), dtype=images[0].dtype)
+    for i, k in enumerate(image_index.tolist()):
+        cv2.warpAffine(images[k], transforms[i], (inp_w, inp_h), dst=crops[i], flags=cv2.INTER_LINEAR)
+    return crops
+
+
+def sample_crops(images, transforms, image_index, input_size, device):
+    """All crops of the frames of one size with a single `grid_sample` (`align_corners=True`)."""
+    inp_h, inp_w = input_size
+    count = len(transforms)
+    # output pixel -> source pixel, the inverse of the uniform scale and translation
+    ratio = transforms[:, 0, 0]
+    u = np.arange(inp_w)[None, :] / ratio[:, None] - transforms[:, 0, 2, None] / ratio[:, None]
+    v = np.arange(inp_h)[None, :] / ratio[:, None] - transforms[:, 1, 2, None] / ratio[:, None]
+    channels = images[0].shape[2]
+    inps = torch.empty(count, channels, inp_h, inp_w, device=device)
+    by_size = {}
+    for k in image_index.unique().tolist():
+        by_size.setdefault(tuple(images[k].shape), []).append(k)
+    for shape, frames in by_size.items():
+        frame_h, frame_w = shape[:2]
+        rows = [torch.nonzero(image_index == k, as_tuple=True)[0] for k in frames]
+        per_frame = max(len(r) for r in rows)
+        # every frame gets `per_frame` crops stacked along the height, unused ones sample outside the frame
+        grid = torch.full((len(frames), per_frame, inp_h, inp_w, 2), -2.0, dtype=torch.float64)
+        for i, r in enumerate(rows):
+            gx = torch.from_numpy(u[r.numpy()] * (2.0 / (frame_w - 1)) - 1)
+            gy = torch.from_numpy(v[r.numpy()] * (2.0 / (frame_h - 1)) - 1)
+            grid[i, :len(r), :, :, 0] = gx[:, None, :]
+            grid[i, :len(r), :, :, 1] = gy[:, :, None]
+        grid = grid.reshape(len(frames), per_frame * inp_h, inp_w, 2).float().to(device)
+        # stacked as arrays, the frames may be read-only views over message buffers
+        source = torch.from_numpy(np.stack([images[k] for k in frames])).to(device)
+        uint8 = source.dtype == torch.uint8
+        source = source.reshape(len(frames), frame_h, frame_w, channels).permute(0, 3, 1, 2).float()
+        warped = F.grid_sample(source, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+        warped = warped.reshape(len(frames), channels, per_frame, inp_h, inp_w).transpose(1, 2)
+        if uint8:
+            # cv2.warpAffine rounds back to the source type
+            warped = warped.round()
+        for i, r in enumerate(rows):
+            inps[r.to(device)] = warped[i, :len(r)]
+    return _rescale(inps, inps.amax(dim=(1, 2, 3)))
+
+
+def crop_boxes(images, boxes, image_index, input_size, device=None):
+    """
+    Crops `boxes` (N x 4, `xmin, ymin, xmax, ymax`) out of `images` (H x W x C arrays), `image_index`
+    is the image each box belongs to. Returns the N x C x H x W inputs of the pose model and the boxes
+    that were cropped, as `SimpleTransform.test_transform` does for a single box.
+    """
+    inp_h, inp_w = input_size
+    image_index = torch.as_tensor(image_index, dtype=torch.long)
+    center, scale = box_to_center_scale(boxes, float(inp_w) / inp_h)
+    cropped_boxes = center_scale_to_box(center, scale)
+    if boxes.shape[0] == 0:
+        return torch.zeros(0, 3, inp_h, inp_w), cropped_boxes
+    transforms = affine_transforms(center, scale, input_size)
+    images = [np.ascontiguousarray(image) for image in images]
+    if device is not None and torch.device(device).type != 'cpu':
+        return sample_crops(images, transforms, image_index, input_size, device).cpu(), cropped_boxes
+    return normalize(warp_crops(images, transforms, image_index, input_size)), cropped_boxes
+
+
+def heatmaps_to_coords(heatmaps, boxes):
+    """
+    `heatmap_to_coord_simple` for N x K x H x W `heatmaps` and the N cropped boxes (`xmin, ymin, xmax,
+    ymax`) they were estimated on. The peak of every heatmap is moved a quarter pixel towards its higher
+    neighbours and mapped back into the frame, returns N x K x 2 coordinates and N x K x 1 peak values.
+    """
+    count, joints, hm_h, hm_w = heatmaps.shape
+    flat = heatmaps.float().reshape(count, joints, hm_h * hm_w)
+    idx = flat.argmax(dim=2, keepdim=True)
+    maxvals = flat.gather(2, idx)
+    coords = torch.cat([idx % hm_w, idx // hm_w], dim=2).float()
+    # heatmaps with no positive value decode to the corner
+    coords *= (maxvals > 0).float()
+    px, py = coords[..., 0].long(), coords[..., 1].long()
+    inside = ((px > 1) & (px < hm_w - 1) & (py > 1) & (py < hm_h - 1)).float()
+    px, py = px.clamp(1, hm_w - 2), py.clamp(1, hm_h - 2)
+    neighbours = torch.stack([py * hm_w + px + 1, py * hm_w + px - 1, (py + 1) * hm_w + px, (py - 1) * hm_w + px], dim=2)
+    values = flat.gather(2, neighbours)
+    diff = torch.stack([values[..., 0] - values[..., 1], values[..., 2] - values[..., 3]], dim=2)
+    coords += diff.sign() * 0.25 * inside[..., None]
+    # the inverse of the crop's affine transform, a uniform scale by `box width / heatmap width` about the box center
+    boxes = boxes.float()
+    ratio = (boxes[:, 2] - boxes[:, 0]) / hm_w
+    center = (boxes[:, :2] + boxes[:, 2:]) * 0.5
+    offset = torch.tensor([hm_w * 0.5, hm_h * 0.5])
+    preds = (coords - offset) * ratio[:, None, None] + center[:, None, :]
+    return preds, maxvals
@@ -0,0 +1,114 @@
+"""
+Compressed transport for image fields (`orig_img`, `img`) in pipeline messages.
+
+Codecs are configured per field with `IMAGE_CODECS`, e.g. `orig_img=jpeg:90,img=zstd:3`. The codec
+is recorded in the packed value so `unpackb` decodes it whatever the reader's settings are.
+
+    raw         uncompressed buffer (the default for fields without a codec)
+    jpeg[:q]    lossy, uint8 HxW or HxWxC images only, q is the quality (default 90)
+    png[:l]     lossless, uint8 HxW or HxWxC images only, l is the compression level (default 1)
+    lz4         lossless, any array
+    zstd[:l]    lossless, any array, l is the compression level (default 3)
+"""
+import logging
+
+import cv2
+import msgpack
+import numpy as np
+import torch
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODECS = ("raw", "jpeg", "png", "lz4", "zstd")
+
+
+def parse_codecs(spec):
+    """Parses `field=codec[:param],...` into `{field: (codec, param)}`."""
+    codecs = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        field, _, codec = item.partition("=")
+        name, _, param = codec.strip().partition(":")
+        if name not in CODECS:
+            raise ValueError(f"unknown image codec `{name}` for field `{field}`, expected one of {CODECS}")
+        if name == "lz4" and lz4_frame is None:
+            raise ValueError("the lz4 image codec requires the `lz4` package")
+        if name == "zstd" and zstandard is None:
+            raise ValueError("the zstd image codec requires the `zstandard` package")
+        codecs[field.strip()] = (name, int(param) if param else None)
+    return codecs
+
+
+def _is_image(array, channels):
+    return array.dtype == np.uint8 and (array.ndim == 2 or (array.ndim == 3 and array.shape[2] in channels))
+
+
+def compress(array, codec, param=None):
+    """
+    Returns `(codec, payload)` for `array`, or None when `codec` does not apply to it (jpeg/png of a
+    non uint8 image) and the field should be shipped uncompressed.
+
+    Channel order is kept as it is, RGB frames come back as RGB.
+    """
+    if codec == "raw":
+        return None
+    if codec in ("jpeg", "png"):
+        if not _is_image(array, (1, 3) if codec == "jpeg" else (1, 3, 4)):
+            return None
+        if codec == "jpeg":
+            flags = [cv2.IMWRITE_JPEG_QUALITY, 90 if param is None else param]
+        else:
+            flags = [cv2.IMWRITE_PNG_COMPRESSION, 1 if param is None else param]
+        ok, encoded = cv2.imencode(f".{codec}", np.ascontiguousarray(array), flags)
+        if not ok:
+            logging.warning("%s encoding failed, sending the image uncompressed", codec)
+            return None
+        return codec, encoded.tobytes()
+    buffer = np.ascontiguousarray(array)
+    if codec == "lz4":
+        return codec, lz4_frame.compress(buffer, store_size=True)
+    return codec, zstandard.ZstdCompressor(level=3 if param is None else param).compress(buffer)
+
+
+def decompress(codec, payload, dtype, shape):
+    if codec in ("jpeg", "png"):
+        array = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    elif codec == "lz4":
+        array = np.frombuffer(lz4_frame.decompress(payload), dtype=dtype)
+    elif codec == "zstd":
+        array = np.frombuffer(zstandard.ZstdDecompressor().decompress(payload), dtype=dtype)
+    else:
+        raise ValueError(f"unknown image codec `{codec}`")
+    return array.reshape(shape)
+
+
+def encode_image(value, codec, param=None):
+    """Packs `value` (an ndarray or tensor) for an ExtType, or returns None to leave it unchanged."""
+    is_tensor = isinstance(value, torch.Tensor)
+    if is_tensor and value.dtype == torch.bfloat16:
+        return None
+    array = value.detach().cpu().numpy() if is_tensor else value
+    if not isinstance(array, np.ndarray) or array.dtype.hasobject:
+        return None
+    compressed = compress(array, codec, param)
+    if compressed is None:
+        return None
+    name, payload = compressed
+    return msgpack.packb([name, is_tensor, array.dtype.str, list(array.shape), payload], use_bin_type=True)
+
+
+def decode_image(data):
+    name, is_tensor, dtype, shape, payload = msgpack.unpackb(data, raw=False)
+    array = decompress(name, payload, np.dtype(dtype), tuple(shape))
+    if is_tensor:
+        # lz4/zstd output is immutable bytes, torch needs a writable buffer
+        return torch.from_numpy(array if array.flags.writeable else array.copy())
+    return array
@@ -0,0 +1,155 @@
+"""
+Node-local store for decoded frames so pipeline messages can carry a `FrameRef` instead of pixels.
+
+Frames are written as `.npy` files under `FRAME_STORE_DIRECTORY` and read back memory mapped. Every
+entry has a reference count, the stage that finishes with a frame releases it and the files are
+removed when the count reaches zero. Resolving, acquiring or releasing an entry marks it as in use,
+entries that are never released (a worker crashed, a message was dropped) are evicted once they have
+not been used for `FRAME_STORE_TTL` seconds, whatever their count.
+"""
+from dataclasses import dataclass
+import fcntl
+import hashlib
+import logging
+import os
+import time
+from uuid import uuid4
+
+import numpy as np
+
+from producer import settings as s
+
+
+@dataclass(frozen=True)
+class FrameRef:
+    path: str
+    frame_num: int
+    name: str
+
+
+class FrameStore:
+
+    def __init__(self, directory, ttl=3600, sweep_interval=60):
+        self.directory = directory
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0
+
+    def _entry_path(self, ref, extension):
+        video_key = hashlib.sha1(ref.path.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, video_key, f"{ref.frame_num}.{ref.name}.{extension}")
+
+    def put(self, path, frame_num, name, array, refs=1):
+        ref = FrameRef(path, frame_num, name)
+        data_path = self._entry_path(ref, "npy")
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        with open(self._entry_path(ref, "refs"), 'w') as handle:
+            handle.write(str(refs))
+        tmp_path = f"{data_path}.{uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as handle:
+            np.save(handle, np.ascontiguousarray(array))
+        os.replace(tmp_path, data_path)
+        if time.time() - self._last_sweep > self.sweep_interval:
+            self.evict_expired()
+        return ref
+
+    def get(self, ref):
+        try:
+            # the eviction sweep goes by when the reference count was last used
+            os.utime(self._entry_path(ref, "refs"))
+        except FileNotFoundError:
+            pass
+        # copy-on-write mapping, pages are shared with the file until a caller writes to them
+        return np.load(self._entry_path(ref, "npy"), mmap_mode='c')
+
+    def acquire(self, ref, count=1):
+        return self._adjust(ref, count)
+
+    def release(self, ref, count=1):
+        return self._adjust(ref, -count)
+
+    def _adjust(self, ref, delta):
+        try:
+            fd = os.open(self._entry_path(ref, "refs"), os.O_RDWR)
+        except FileNotFoundError:
+            return 0
+        with os.fdopen(fd, 'r+') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            count = int(handle.read() or 0)
+            if count <= 0:
+                # removed by another worker while we were waiting on the lock
+                return 0
+            count += delta
+            handle.seek(0)
+            handle.truncate()
+            handle.write(str(max(count, 0)))
+            handle.flush()
+            if count <= 0:
+                self._remove(ref)
+        return count
+
+    def _remove(self, ref):
+        for extension in ("npy", "refs"):
+            try:
+                os.remove(self._entry_path(ref, extension))
+            except FileNotFoundError:
+                pass
+
+    def evict_expired(self):
+        self._last_sweep = time.time()
+        cutoff = self._last_sweep - self.ttl
+        evicted = 0
+        if not os.path.isdir(self.directory):
+            return evicted
+        for video_dir in os.scandir(self.directory):
+            if not video_dir.is_dir():
+                continue
+            entries = {entry.name: entry for entry in os.scandir(video_dir.path)}
+            for name, entry in entries.items():
+                # a frame lives as long as its reference count is used, frames without one (left over
+                # from a crash) and temporary files by their own age
+                if name.endswith(".npy") and f"{name[:-len('npy')]}refs" in entries:
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        evicted += 1
+                        if name.endswith(".refs"):
+                            os.remove(f"{entry.path[:-len('refs')]}npy")
+                            evicted += 1
+                except FileNotFoundError:
+                    pass
+            try:
+                os.rmdir(video_dir.path)
+            except OSError:
+                pass
+        if evicted:
+            logging.info("evicted %s expired frame store files", evicted)
+        return evicted
+
+
+_STORE = None
+
+
+def get_frame_store():
+    global _STORE
+    if _STORE is None:
+        _STORE = FrameStore(s.FRAME_STORE_DIRECTORY, ttl=s.FRAME_STORE_TTL)
+    return _STORE
+
+
+def resolve(value):
+    """Returns the pixels for `value`, which is either a `FrameRef` or the pixels themselves."""
+    if isinstance(value, FrameRef):
+        return get_frame_store().get(value)
+    return value
+
+
+def acquire(value, count=1):
+    if isinstance(value, FrameRef) and count > 0:
+        get_frame_store().acquire(value, count)
+
+
+def release(value, count=1):
+    if isinstance(value, FrameRef) and count > 0:
+        get_frame_store().release(value, count)
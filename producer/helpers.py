@@ -7,13 +7,17 @@ import io
 import json
 import logging
 import os
+import struct
+import warnings
 
 import msgpack
 import numpy as np
 import pika
 import torch
 
-from producer.settings import LOG_FORMAT, LOG_LEVEL
+from producer import codecs
+from producer.framestore import FrameRef
+from producer.settings import IMAGE_CODECS, LOG_FORMAT, LOG_LEVEL
 
 ISO_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 
@@ -57,7 +61,87 @@ def rabbit_params():
     )
 
 
-def __encoder(obj):
+EXT_NDARRAY = 1
+EXT_TORCH_TENSOR = 2
+EXT_FRAME_REF = 3
+EXT_ENCODED_IMAGE = 4
+
+# raw buffers are written at this offset inside the ext payload so decoded
+# views stay aligned for every dtype we ship
+_EXT_ALIGNMENT = 16
+
+
+_TORCH_NUMPY_DTYPES = {
+    torch.bool, torch.uint8, torch.int8, torch.int16, torch.int32, torch.int64,
+    torch.float16, torch.float32, torch.float64,
+}
+
+
+def _align(offset):
+    return (offset + _EXT_ALIGNMENT - 1) // _EXT_ALIGNMENT * _EXT_ALIGNMENT
+
+
+def _pack_array(code, dtype_name, array):
+    """
+    Packs a numpy array as `<header length><header><padding><raw buffer>`.
+
+    The header is a msgpack list of [dtype, shape, strides]. C- and Fortran-ordered arrays are
+    written as they are, anything else is made contiguous first.
+    """
+    if not (array.flags.c_contiguous or array.flags.f_contiguous):
+        array = np.ascontiguousarray(array)
+    header = msgpack.packb([dtype_name, list(array.shape), list(array.strides)], use_bin_type=True)
+    offset = _align(2 + len(header))
+    prefix = struct.pack("<H", len(header)) + header
+    prefix += b"\0" * (offset - len(prefix))
+    # the transpose of a Fortran-ordered array exposes the same memory as a C-ordered buffer
+    raw = array if array.flags.c_contiguous else array.T
+    return msgpack.ExtType(code, b"".join((prefix, raw.reshape(-1).view(np.uint8))))
+
+
+def _unpack_array(data):
+    (header_length,) = struct.unpack_from("<H", data)
+    dtype_name, shape, strides = msgpack.unpackb(data[2:2 + header_length], raw=False)
+    buffer = memoryview(data)[_align(2 + header_length):]
+    return dtype_name, tuple(shape), tuple(strides), buffer
+
+
+def _encode_ndarray(obj):
+    if obj.dtype.hasobject:
+        return None
+    return _pack_array(EXT_NDARRAY, obj.dtype.str, obj)
+
+
+def _decode_ndarray(data):
+    dtype_name, shape, strides, buffer = _unpack_array(data)
+    # read-only view over the message buffer, copy before writing to it
+    return np.ndarray(shape, dtype=np.dtype(dtype_name), buffer=buffer, strides=strides)
+
+
+def _encode_tensor(obj):
+    obj = obj.detach()
+    if obj.device.type != "cpu":
+        obj = obj.cpu()
+    if obj.dtype not in _TORCH_NUMPY_DTYPES or obj.is_sparse:
+        return None
+    return _pack_array(EXT_TORCH_TENSOR, str(obj.dtype).split(".")[-1], obj.numpy())
+
+
+def _decode_tensor(data):
+    dtype_name, shape, strides, buffer = _unpack_array(data)
+    dtype = getattr(torch, dtype_name)
+    if buffer.nbytes == 0:
+        return torch.empty(shape, dtype=dtype)
+    itemsize = torch.empty((), dtype=dtype).element_size()
+    with warnings.catch_warnings():
+        # the message buffer is immutable, the tensor shares it instead of copying and consumers
+        # that write in place copy it first
+        warnings.simplefilter("ignore", UserWarning)
+        flat = torch.frombuffer(buffer, dtype=dtype)
+    return flat.as_strided(shape, [stride // itemsize for stride in strides])
+
+
+def _legacy_encoder(obj):
     if isinstance(obj, torch.Tensor):
         bites = io.BytesIO()
         torch.save(obj, bites)
@@ -69,7 +153,22 @@ def __encoder(obj):
     return obj
 
 
+def __encoder(obj):
+    ext = None
+    if isinstance(obj, FrameRef):
+        return msgpack.ExtType(EXT_FRAME_REF, msgpack.packb([obj.path, obj.frame_num, obj.name], use_bin_type=True))
+    if isinstance(obj, torch.Tensor):
+        ext = _encode_tensor(obj)
+    elif isinstance(obj, np.ndarray):
+        ext = _encode_ndarray(obj)
+    if ext is None:
+        # dtypes without a raw buffer layout go through the pickled format
+        return _legacy_encoder(obj)
+    return ext
+
+
 def __decoder(obj):
+    # messages packed before the raw buffer codec are still in the queues
     if '__torch_tensor__' in obj:
         byio = io.BytesIO(obj['__torch_tensor__'])
         obj = torch.load(byio)
@@ -79,12 +178,45 @@ def __decoder(obj):
     return obj
 
 
-def packb(obj):
+def __ext_hook(code, data):
+    if code == EXT_NDARRAY:
+        return _decode_ndarray(data)
+    if code == EXT_TORCH_TENSOR:
+        return _decode_tensor(data)
+    if code == EXT_FRAME_REF:
+        return FrameRef(*msgpack.unpackb(data, raw=False))
+    if code == EXT_ENCODED_IMAGE:
+        return codecs.decode_image(data)
+    return msgpack.ExtType(code, data)
+
+
+_IMAGE_CODECS = codecs.parse_codecs(IMAGE_CODECS)
+
+
+def _encode_fields(obj, field_codecs):
+    encoded = dict(obj)
+    for field, (codec, param) in field_codecs.items():
+        if field in encoded:
+            data = codecs.encode_image(encoded[field], codec, param)
+            if data is not None:
+                encoded[field] = msgpack.ExtType(EXT_ENCODED_IMAGE, data)
+    return encoded
+
+
+def packb(obj, image_codecs=None):
+    """
+    Packs `obj` with msgpack. When `obj` is a dict, fields named in `image_codecs` (defaults to the
+    `IMAGE_CODECS` setting, see `producer.codecs`) are compressed with their codec.
+    """
+    if image_codecs is None:
+        image_codecs = _IMAGE_CODECS
+    if image_codecs and isinstance(obj, dict):
+        obj = _encode_fields(obj, image_codecs)
     return msgpack.packb(obj, default=__encoder, use_bin_type=True)
 
 
 def unpackb(obj):
-    return msgpack.unpackb(obj, object_hook=__decoder, raw=False)
+    return msgpack.unpackb(obj, object_hook=__decoder, ext_hook=__ext_hook, raw=False)
 
 
 def columnarize(dicts, keys):
@@ -95,6 +227,69 @@ def columnarize(dicts, keys):
     return buffer
 
 
+class Column:
+    """A field of a batch of dicts, read from the dicts as it is indexed instead of copied into a list."""
+
+    __slots__ = ("dicts", "key")
+
+    def __init__(self, dicts, key):
+        self.dicts = dicts
+        self.key = key
+
+    def __len__(self):
+        return len(self.dicts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [obj.get(self.key) for obj in self.dicts[index]]
+        return self.dicts[index].get(self.key)
+
+    def __iter__(self):
+        return (obj.get(self.key) for obj in self.dicts)
+
+
+def column_views(dicts, keys):
+    """`columnarize` without the lists, every key is a `Column` view of `dicts`."""
+    return {k: Column(dicts, k) for k in keys}
+
+
+class BatchAssembler:
+    """
+    Stacks a field of a batch of messages (tensors, arrays or numbers) into an N x ... tensor, as
+    `list_to_tensor` does. The tensor is a view of a buffer kept per field for the next batches, grown
+    to the largest batch seen and at least `max_batch`, pinned when `pin_memory` is set and a GPU is
+    there. Arrays are stacked through zero-copy `torch.from_numpy` views.
+
+    A stacked tensor is only valid until its field is stacked again: a worker serializes the results of
+    a batch before it processes the next one, results holding rows of it are safe within a batch.
+    """
+
+    def __init__(self, max_batch=0, pin_memory=False):
+        self.max_batch = max_batch
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._buffers = {}
+
+    def buffer(self, key, count, shape, dtype):
+        buffer = self._buffers.get((key, shape, dtype))
+        if buffer is None or buffer.shape[0] < count:
+            buffer = torch.empty((max(count, self.max_batch), *shape), dtype=dtype, pin_memory=self.pin_memory)
+            self._buffers[(key, shape, dtype)] = buffer
+        return buffer[:count]
+
+    def stack(self, dicts, key, dtype=torch.float32):
+        """The `key` field of `dicts` stacked as `dtype`."""
+        first = dicts[0][key]
+        if not hasattr(first, 'shape'):
+            out = self.buffer(key, len(dicts), (), dtype)
+            out.copy_(torch.tensor([obj[key] for obj in dicts]))
+            return out
+        values = [obj[key] if isinstance(obj[key], torch.Tensor) else torch.from_numpy(np.asarray(obj[key])) for obj in dicts]
+        out = self.buffer(key, len(dicts), tuple(first.shape), dtype)
+        if all(value.dtype == dtype for value in values):
+            return torch.stack(values, out=out)
+        return out.copy_(torch.stack(values))
+
+
 def index_dicts(dicts, key, stringify=False):
     index = {}
     for obj in dicts:
@@ -1,4 +1,8 @@
+from collections import defaultdict
+import logging
+import math
 import os
+import time
 
 from telegraf.client import TelegrafClient
 
@@ -9,3 +13,55 @@ HOST = os.environ.get("TELEGRAF_HOST", 'localhost')
 def emit(name, values, tags=None):
     client = TelegrafClient(host=HOST, port=8092)
     client.metric(name, values, tags=tags)
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+class StageMetrics:
+    """
+    Collects the durations of a worker's stages and reports them through `emit` every `interval`
+    seconds, one point per stage with the p50/p95/p99 latency and the items handled per second.
+    """
+
+    def __init__(self, name, tags=None, interval=60):
+        self.name = name
+        self.tags = tags or {}
+        self.interval = interval
+        self._samples = defaultdict(list)
+        self._items = defaultdict(int)
+        self._started = time.monotonic()
+
+    def observe(self, stage, seconds, items=1):
+        self._samples[stage].append(seconds)
+        self._items[stage] += items
+
+    def report(self, force=False):
+        elapsed = time.monotonic() - self._started
+        if elapsed < self.interval and not force:
+            return
+        samples, items = self._samples, self._items
+        self._samples, self._items = defaultdict(list), defaultdict(int)
+        self._started = time.monotonic()
+        for stage, durations in samples.items():
+            durations.sort()
+            busy = sum(durations)
+            values = {
+                "count": len(durations),
+                "items": items[stage],
+                "seconds": busy,
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "p99": percentile(durations, 99),
+                "max": durations[-1],
+                "items_per_second": items[stage] / elapsed if elapsed > 0 else 0.0,
+                "items_per_busy_second": items[stage] / busy if busy > 0 else 0.0,
+            }
+            try:
+                emit(self.name, values, {**self.tags, "stage": stage})
+            except Exception as err:
+                logging.warning("could not report %s metrics [%s]", stage, str(err))
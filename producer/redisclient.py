@@ -0,0 +1,27 @@
+"""
+The process-wide redis client of the beta stages.
+
+Every worker process shares one connection pool to `REDIS_HOST:REDIS_PORT` instead of connecting
+per batch, a thread waits for a free connection once `REDIS_MAX_CONNECTIONS` are in use. Stages
+queue the commands of a whole batch on a pipeline and send them in one round trip,
+`transaction=True` wraps them in MULTI/EXEC when a read has to see the batch's writes and nothing
+else.
+"""
+import os
+
+import redis
+
+from producer import settings as s
+
+
+_POOL = None
+_POOL_PID = None
+
+
+def get_redis():
+    """A client on the process' connection pool, the pool is created again in a forked child."""
+    global _POOL, _POOL_PID
+    if _POOL is None or _POOL_PID != os.getpid():
+        _POOL = redis.BlockingConnectionPool(host=s.REDIS_HOST, port=s.REDIS_PORT, db=s.REDIS_DB, max_connections=s.REDIS_MAX_CONNECTIONS)
+        _POOL_PID = os.getpid()
+    return redis.Redis(connection_pool=_POOL)
@@ -0,0 +1,129 @@
+"""
+Node-local cache of per-frame detection and pose results, so a video that is processed again after a
+failure only recomputes the frames that had not finished.
+
+Entries are content addressed: the key hashes the video (its path, size and modification time), the
+frame, the model that produced the result (checkpoint, backend and quantization) and, for per-box
+results, the box. Values are packed with `producer.helpers.packb` into files under
+`RESULT_CACHE_DIRECTORY`. Reading an entry marks it as recently used, once the entries add up to more
+than `RESULT_CACHE_MAX_BYTES` the least recently used ones are removed. Sizes are checked every
+`sweep_interval` seconds, in between the cache can grow past its bound by what was written since.
+"""
+import hashlib
+import logging
+import os
+import time
+from uuid import uuid4
+
+from producer.helpers import packb, unpackb
+from producer import settings as s
+
+
+# eviction frees space down to this fraction of the bound so every write does not trigger a sweep
+LOW_WATER = 0.9
+
+
+def video_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        # the video is not on this node, it is named by its path alone
+        return os.path.abspath(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class ResultCache:
+
+    def __init__(self, directory, max_bytes, sweep_interval=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0
+
+    def key(self, video_path, frame, model, part=""):
+        return hashlib.sha1(f"{video_key(video_path)}|{frame}|{model}|{part}".encode('utf8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.msgpack")
+
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as handle:
+                value = unpackb(handle.read())
+        except FileNotFoundError:
+            return None
+        except Exception as err:
+            logging.warning("dropping unreadable result cache entry %s [%s]", path, err)
+            self._remove(path)
+            return None
+        try:
+            # the modification time orders entries for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def has(self, key):
+        """Whether `key` is cached, an entry that is checked for is about to be read and counts as used."""
+        try:
+            os.utime(self._entry_path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, value):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as handle:
+            handle.write(packb(value))
+        os.replace(tmp_path, path)
+        if time.time() - self._last_sweep > self.sweep_interval:
+            self.evict()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Removes the least recently used entries while the cache is over `max_bytes`."""
+        self._last_sweep = time.time()
+        if not os.path.isdir(self.directory):
+            return 0
+        entries = []
+        for bucket in os.scandir(self.directory):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return 0
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * LOW_WATER:
+                break
+            self._remove(path)
+            total -= size
+            evicted += 1
+        logging.info("evicted %s result cache entries", evicted)
+        return evicted
+
+
+_CACHE = None
+
+
+def get_result_cache():
+    """The node's result cache, None when `RESULT_CACHE_ENABLED` is off."""
+    global _CACHE
+    if _CACHE is None and s.RESULT_CACHE_ENABLED:
+        _CACHE = ResultCache(s.RESULT_CACHE_DIRECTORY, s.RESULT_CACHE_MAX_BYTES)
+    return _CACHE
@@ -24,11 +24,46 @@ RABBIT_PASSWORD = os.getenv("RABBIT_PASSWORD", "guest")
 RABBIT_PORT = os.getenv("RABBIT_PORT", "5672")
 RABBIT_USER = os.getenv("RABBIT_USER", "guest")
 
+# the redis the beta stages keep image records, box manifests and poses in, see producer.redisclient
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 16))
+
 EXCHANGE = os.getenv("EXCHANGE", "message")
 EXCHANGE_TYPE = os.getenv("EXCHANGE_TYPE", "topic")
 QUEUE = os.getenv("VIDEO_QUEUE_NAME", "queue-name")
 ROUTING_KEY = os.getenv("ROUTING_KEY", QUEUE)
 PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", 1))
+# "push" subscribes with basic_consume, "poll" calls basic_get per message
+CONSUME_MODE = os.getenv("CONSUME_MODE", "push")
+# seconds a partial batch waits for more messages before it is processed
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", 0.5))
+# target seconds of compute per batch, batch sizes adapt to it while a stage is not backlogged. Off (0) by
+# default, a worker opts in with this setting or the `max_latency` of its QueueWorkProcessor
+MAX_BATCH_LATENCY = float(os.getenv("MAX_BATCH_LATENCY", 0))
+# detector batch sizes short batches are padded to, `none` or a list such as `1,2,4,8` (default powers of two)
+DETECTION_BATCH_BUCKETS = os.getenv("DETECTION_BATCH_BUCKETS", "")
+# replace frames that barely differ from the last detected frame of their video with reuse markers
+MOTION_GATE_ENABLED = os.getenv("MOTION_GATE_ENABLED", "false") == "true"
+# mean absolute difference in gray levels below which a frame is gated
+MOTION_GATE_THRESHOLD = float(os.getenv("MOTION_GATE_THRESHOLD", 2.0))
+MOTION_GATE_MAX_SKIP = int(os.getenv("MOTION_GATE_MAX_SKIP", 50))
+# seconds a reuse marker waits for the poses of its reference frame
+MOTION_GATE_PENDING_TTL = int(os.getenv("MOTION_GATE_PENDING_TTL", 3600))
+# frames the video reader hands over at a time, and decodes ahead of the worker
+VIDEO_CHUNK_SIZE = int(os.getenv("VIDEO_CHUNK_SIZE", 8))
+VIDEO_PREFETCH = int(os.getenv("VIDEO_PREFETCH", 64))
+# seconds between reports of the per-stage timings of a worker
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 60))
+# results waiting on a publisher confirm before the processor blocks
+PUBLISH_WINDOW = int(os.getenv("PUBLISH_WINDOW", 256))
+PUBLISH_MAX_ATTEMPTS = int(os.getenv("PUBLISH_MAX_ATTEMPTS", 5))
+PUBLISH_TIMEOUT = float(os.getenv("PUBLISH_TIMEOUT", 300))
+# worker processes per QueueWorkProcessor, processors share one batch queue
+PROCESSORS = int(os.getenv("PROCESSORS", 1))
+PRELOADERS = int(os.getenv("PRELOADERS", 1))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 60))
 
 # TIMEOUT = os.getenv('TIMEOUT', 3600)
 
@@ -39,3 +74,42 @@ ALPHA_POSE_POSEFLOW = os.getenv("ALPHA_POSE_CONFIG", "pretrained_models/fast_res
 MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", 4))
 
 DATA_PROCESS_DIRECTORY = os.getenv("DATA_PROCESS_DIRECTORY", "/data")
+
+# frames are shared between stages on the same node through the frame store instead of being
+# copied into every message
+FRAME_STORE_ENABLED = os.getenv("FRAME_STORE_ENABLED", "false") == "true"
+FRAME_STORE_DIRECTORY = os.getenv("FRAME_STORE_DIRECTORY", os.path.join(DATA_PROCESS_DIRECTORY, "frames"))
+# seconds a frame is kept after its reference count was last used, at least as long as a frame
+# may wait in a queue
+FRAME_STORE_TTL = int(os.getenv("FRAME_STORE_TTL", 3600))
+
+# per-field compression of images crossing the broker, e.g. "orig_img=jpeg:90", see producer.codecs
+IMAGE_CODECS = os.getenv("IMAGE_CODECS", "")
+
+# model inference, see producer.backends: eager, torchscript or onnx, optionally int8 quantized
+# (none, dynamic with onnx only, or static, static calibrates on the inputs saved at *_CALIBRATION)
+MODEL_EXPORT_DIRECTORY = os.getenv("MODEL_EXPORT_DIRECTORY", os.path.join(DATA_PROCESS_DIRECTORY, "models"))
+POSE_BACKEND = os.getenv("POSE_BACKEND", "eager")
+POSE_QUANTIZATION = os.getenv("POSE_QUANTIZATION", "none")
+POSE_CALIBRATION = os.getenv("POSE_CALIBRATION", "")
+# intra-op threads of the model, 0 keeps the processor's share of the cores
+POSE_THREADS = int(os.getenv("POSE_THREADS", 0))
+# eager pose model precision (fp32, bf16 or fp16) and execution modes, comma separated (compile,
+# channels_last, inference_mode). The model falls back to fp32 when its keypoints are more than
+# POSE_CHECK_TOLERANCE heatmap pixels off fp32 on the POSE_CALIBRATION inputs
+POSE_PRECISION = os.getenv("POSE_PRECISION", "fp32")
+POSE_EXECUTION = os.getenv("POSE_EXECUTION", "")
+POSE_CHECK_TOLERANCE = float(os.getenv("POSE_CHECK_TOLERANCE", 1.0))
+DETECTOR_BACKEND = os.getenv("DETECTOR_BACKEND", "eager")
+DETECTOR_QUANTIZATION = os.getenv("DETECTOR_QUANTIZATION", "none")
+DETECTOR_CALIBRATION = os.getenv("DETECTOR_CALIBRATION", "")
+DETECTOR_THREADS = int(os.getenv("DETECTOR_THREADS", 0))
+
+# per-frame detections and poses are kept on the node so a video processed again after a failure
+# skips the frames that had finished, see producer.resultcache
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "false") == "true"
+RESULT_CACHE_DIRECTORY = os.getenv("RESULT_CACHE_DIRECTORY", os.path.join(DATA_PROCESS_DIRECTORY, "results"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+
+# JSON file of per-assignment regions of interest and box filters for detection, see producer.beta.regions
+REGIONS_CONFIG = os.getenv("REGIONS_CONFIG", "")
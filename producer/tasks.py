@@ -11,6 +11,7 @@ from producer import settings as s
 from producer.helpers import get_json, output_json_exists
 from producer._honeycomb import create_inference_execution
 from producer.alpha import AlphaPoser
+from producer.video import FrameSampling
 
 
 class Poser:
@@ -226,7 +227,7 @@ def execute_manifest(path, slot, model, version):
                     output_format="cmu",
                     pose_track=s.ALPHA_POSE_POSEFLOW
                 )
-                poser.process_video(video_path, outdir)
+                poser.process_video(video_path, outdir, sampling=FrameSampling.from_message(obj))
 
 
 def handle_video(video_path):
@@ -18,7 +18,11 @@ def main():
 @click.option('--assignment_id')
 @click.option('--environment_id')
 @click.option('--timestamp')
-def queue_video(path, assignment_id, environment_id, timestamp):
+@click.option('--frame-stride', type=int, default=None, help="decode every nth frame")
+@click.option('--fps', type=float, default=None, help="decode frames at this rate instead, overrides --frame-stride")
+@click.option('--start-offset', type=float, default=None, help="seconds into the video to start at")
+@click.option('--end-offset', type=float, default=None, help="seconds into the video to stop at")
+def queue_video(path, assignment_id, environment_id, timestamp, frame_stride, fps, start_offset, end_offset):
     logging.info("queueing video")
     logging.info(path)
     connection = pika.BlockingConnection(rabbit_params())
@@ -30,6 +34,10 @@ def queue_video(path, assignment_id, environment_id, timestamp):
         "assignment_id": assignment_id,
         "environment_id": environment_id,
         "timestamp": timestamp,
+        "frame_stride": frame_stride,
+        "fps": fps,
+        "start_offset": start_offset,
+        "end_offset": end_offset,
     })
     channel.basic_publish("videos", "extract-frames", body)
     logging.info("done")
@@ -0,0 +1,156 @@
+"""
+Threaded video decoding for the ingestion workers.
+
+`VideoReader` decodes a video in a background thread and keeps up to `prefetch` frames ready in
+chunks of `chunk_size`, so the worker publishes one chunk while the next is being decoded.
+
+`FrameSampling` selects the frames to decode from a frame stride or a target fps and optional start
+and end offsets (seconds into the video). Skipped frames are grabbed without being retrieved and a
+start offset is reached with a seek where the container supports it.
+"""
+from collections import namedtuple
+import itertools
+import logging
+import math
+import queue
+import threading
+
+import cv2
+
+
+# the cameras record at 10 fps, assumed when a container does not report its frame rate
+DEFAULT_FPS = 10
+
+Frame = namedtuple('Frame', ['frame_num', 'image'])
+
+_END = object()
+
+
+class FrameSampling:
+
+    def __init__(self, stride=1, fps=None, start=None, end=None):
+        self.stride = max(1, int(stride or 1))
+        self.fps = fps
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def from_message(cls, obj):
+        """
+        Sampling requested by a `videos` message, `frame_stride`, `fps`, `start_offset` and `end_offset`.
+        None when the message asks for none of them, every frame is decoded.
+        """
+        if all(obj.get(key) is None for key in ("frame_stride", "fps", "start_offset", "end_offset")):
+            return None
+        return cls(obj.get("frame_stride"), obj.get("fps"), obj.get("start_offset"), obj.get("end_offset"))
+
+    def frame_nums(self, video_fps, frame_count=0):
+        """Indices of the frames to decode, unbounded when neither an end nor the frame count is known."""
+        video_fps = video_fps or DEFAULT_FPS
+        stride = max(1, round(video_fps / self.fps)) if self.fps else self.stride
+        first = math.ceil(self.start * video_fps) if self.start else 0
+        last = int(self.end * video_fps) if self.end is not None else None
+        if frame_count > 0:
+            last = frame_count if last is None else min(last, frame_count)
+        if last is None:
+            return itertools.count(first, stride)
+        return range(first, last, stride)
+
+
+def _seek(stream, frame_num):
+    """Seeks to `frame_num` and returns the position the stream is at afterwards."""
+    if stream.set(cv2.CAP_PROP_POS_FRAMES, frame_num) and int(stream.get(cv2.CAP_PROP_POS_FRAMES)) == frame_num:
+        return frame_num
+    # inexact seek, start over and grab up to the frame instead
+    logging.info("could not seek to frame %s, grabbing frames up to it", frame_num)
+    stream.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    return 0
+
+
+def read_frames(stream, frame_nums):
+    """Yields `(frame_num, image)` for the selected frames of an opened `cv2.VideoCapture`."""
+    position = 0
+    for frame_num in frame_nums:
+        if position == 0 and frame_num > 0:
+            position = _seek(stream, frame_num)
+        while position < frame_num:
+            if not stream.grab():
+                return
+            position += 1
+        grabbed, image = stream.read()
+        if not grabbed:
+            return
+        position += 1
+        yield frame_num, image
+
+
+class VideoReader:
+
+    def __init__(self, path, chunk_size=8, prefetch=64, sampling=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.sampling = sampling or FrameSampling()
+        self.fps = None
+        self.frame_count = None
+        self._chunks = queue.Queue(maxsize=max(1, prefetch // chunk_size))
+        self._stop = threading.Event()
+        self._stream = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        self._stream = cv2.VideoCapture(self.path)
+        if not self._stream.isOpened():
+            raise IOError(f"cannot capture source {self.path}")
+        self.fps = self._stream.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+        self.frame_count = int(self._stream.get(cv2.CAP_PROP_FRAME_COUNT))
+        self._thread = threading.Thread(target=self._read, name="video-reader", daemon=True)
+        self._thread.start()
+        return self
+
+    def _read(self):
+        chunk = []
+        try:
+            for frame_num, image in read_frames(self._stream, self.sampling.frame_nums(self.fps, self.frame_count)):
+                if self._stop.is_set():
+                    break
+                chunk.append(Frame(frame_num, image))
+                if len(chunk) == self.chunk_size:
+                    self._put(chunk)
+                    chunk = []
+            if chunk:
+                self._put(chunk)
+            self._put(_END)
+        except Exception as err:
+            # raised again on the consuming thread
+            self._put(err)
+        finally:
+            self._stream.release()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        """Yields lists of up to `chunk_size` frames in order."""
+        while True:
+            item = self._chunks.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
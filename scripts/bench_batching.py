@@ -0,0 +1,76 @@
+"""
+Compares `columnarize` and `list_to_tensor` with `column_views` and `BatchAssembler` from
+`producer.helpers` on decoded messages of the pose estimation (box messages) and deduplication
+(pose messages) stages, and checks they assemble the same tensors.
+
+    python scripts/bench_batching.py --batch-size 20 --batch-size 200 --repeat 200
+"""
+import time
+from uuid import uuid4
+
+import click
+import torch
+
+from producer.helpers import BatchAssembler, column_views, columnarize, list_to_tensor, packb, unpackb
+
+
+def box_messages(count):
+    return [unpackb(packb({
+        "image_id": str(uuid4()),
+        "box_id": str(uuid4()),
+        "box": torch.rand(4) * 1000,
+        "score": torch.rand(1),
+        "id": torch.zeros(1),
+    })) for _ in range(count)]
+
+
+def pose_messages(count):
+    return [unpackb(packb({
+        "box_id": str(uuid4()),
+        "bbox": torch.rand(4) * 1000,
+        "score": torch.rand(1),
+        "keypoints": torch.rand(17, 2) * 1000,
+        "kp_score": torch.rand(17, 1),
+    })) for _ in range(count)]
+
+
+def current(batch, keys, fields):
+    columns = columnarize(batch, keys)
+    return [list_to_tensor(columns[field]) for field in fields]
+
+
+def assembled(assembler, batch, keys, fields):
+    # the metadata columns are views, built for a like for like comparison
+    column_views(batch, [key for key in keys if key not in fields])
+    return [assembler.stack(batch, field) for field in fields]
+
+
+def timed(func, repeat):
+    func()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+@click.command()
+@click.option('--batch-size', 'batch_sizes', multiple=True, default=[20, 200], type=int)
+@click.option('--repeat', default=200)
+def main(batch_sizes, repeat):
+    stages = [
+        ("estimate", box_messages, ["image_id", "box_id", "box", "score", "id"], ["box", "score", "id"]),
+        ("deduplicate", pose_messages, ["bbox", "score", "box_id", "keypoints", "kp_score"], ["bbox", "score", "keypoints", "kp_score"]),
+    ]
+    print(f"{'stage':<14}{'batch':>8}{'current us':>14}{'assembled us':>14}{'speedup':>10}{'same':>6}")
+    for name, messages, keys, fields in stages:
+        for batch_size in batch_sizes:
+            batch = messages(batch_size)
+            assembler = BatchAssembler(max_batch=max(batch_sizes))
+            same = all(torch.equal(a, b) for a, b in zip(current(batch, keys, fields), assembled(assembler, batch, keys, fields)))
+            before = timed(lambda: current(batch, keys, fields), repeat)
+            after = timed(lambda: assembled(assembler, batch, keys, fields), repeat)
+            print(f"{name:<14}{batch_size:>8}{before:>14.1f}{after:>14.1f}{before / after:>10.2f}{str(same):>6}")
+
+
+if __name__ == '__main__':
+    main()
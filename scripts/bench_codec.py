@@ -0,0 +1,92 @@
+"""
+Compares the pickled (torch.save/np.save) message format with the raw buffer
+ExtType codec in `producer.helpers` for the payloads the beta pipeline ships,
+then the image codecs from `producer.codecs` for the `orig_img` and `img` fields.
+
+    python scripts/bench_codec.py --repeat 20 --video /data/sample.mp4
+"""
+import time
+
+import click
+import cv2
+import msgpack
+import numpy as np
+import torch
+
+from producer import codecs, helpers
+
+
+IMAGE_CODECS = ["raw", "jpeg:95", "jpeg:90", "jpeg:75", "png:1", "lz4", "zstd:1", "zstd:3"]
+
+
+def legacy_packb(obj):
+    return msgpack.packb(obj, default=helpers._legacy_encoder, use_bin_type=True)
+
+
+def timed(func, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(arg)
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def read_frame(video):
+    if video:
+        stream = cv2.VideoCapture(video)
+        grabbed, frame = stream.read()
+        stream.release()
+        assert grabbed, f"could not read a frame from {video}"
+        return frame
+    # smoothed noise compresses roughly like a classroom frame, uniform noise does not compress at all
+    return cv2.GaussianBlur(np.random.randint(0, 255, (1080, 1920, 3), dtype=np.uint8), (15, 15), 5)
+
+
+def letterbox(frame, inp_dim=608):
+    height, width = frame.shape[:2]
+    ratio = min(inp_dim / width, inp_dim / height)
+    new_w, new_h = int(width * ratio), int(height * ratio)
+    canvas = np.full((inp_dim, inp_dim, 3), 128, dtype=np.uint8)
+    top, left = (inp_dim - new_h) // 2, (inp_dim - new_w) // 2
+    canvas[top:top + new_h, left:left + new_w] = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
+    return torch.from_numpy(canvas[:, :, ::-1].transpose((2, 0, 1)).copy()).float().div(255.0).unsqueeze(0)
+
+
+def payloads(frame):
+    return [
+        # ImageExtractionWorker ships the RGB flipped view of the decoded frame
+        ("orig_img 1080p", {"orig_img": frame[:, :, ::-1]}),
+        ("inp crops 20x3x256x192", {"boxes": [{"inp": torch.rand(3, 256, 192)} for _ in range(20)]}),
+    ]
+
+
+@click.command()
+@click.option('--repeat', default=20)
+@click.option('--video', default=None, help="read the benchmark frame from this video instead of a synthetic one")
+def main(repeat, video):
+    frame = read_frame(video)
+    print(f"{'payload':<26}{'codec':<8}{'bytes':>12}{'encode ms':>12}{'decode ms':>12}")
+    for name, payload in payloads(frame):
+        for codec, pack in (("legacy", legacy_packb), ("raw", helpers.packb)):
+            encode_ms, message = timed(pack, payload, repeat)
+            decode_ms, _ = timed(helpers.unpackb, message, repeat)
+            print(f"{name:<26}{codec:<8}{len(message):>12}{encode_ms:>12.2f}{decode_ms:>12.2f}")
+
+    print()
+    print(f"{'field':<10}{'codec':<10}{'bytes':>12}{'ratio':>8}{'encode ms':>12}{'decode ms':>12}")
+    fields = {"orig_img": frame[:, :, ::-1], "img": letterbox(frame)}
+    for field, value in fields.items():
+        raw_size = None
+        for spec in IMAGE_CODECS:
+            field_codecs = codecs.parse_codecs(f"{field}={spec}")
+            if spec != "raw" and codecs.encode_image(value, *field_codecs[field]) is None:
+                # jpeg/png only apply to uint8 images
+                continue
+            pack = lambda obj: helpers.packb(obj, image_codecs=field_codecs)
+            encode_ms, message = timed(pack, {field: value}, repeat)
+            decode_ms, _ = timed(helpers.unpackb, message, repeat)
+            raw_size = raw_size or len(message)
+            print(f"{field:<10}{spec:<10}{len(message):>12}{raw_size / len(message):>8.1f}{encode_ms:>12.2f}{decode_ms:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Compares the per-box crop the pipeline used to do (`SimpleTransform.test_transform` and a copy
+into `inps` for every box) with the batched `producer.beta.transforms.crop_boxes`, warping on the
+CPU and with `grid_sample` on `--device`.
+
+    python scripts/bench_crop.py --images 2 --boxes 20 --repeat 10 --device cuda:0
+"""
+import time
+
+import click
+import cv2
+import numpy as np
+import torch
+
+from producer.beta.transforms import PIXEL_MEANS, box_to_center_scale, center_scale_to_box, crop_boxes, sample_crops, affine_transforms
+
+
+INPUT_SIZE = (256, 192)
+
+
+def test_transform(src, bbox, input_size=INPUT_SIZE):
+    """`SimpleTransform.test_transform` without the AlphaPose dependency."""
+    inp_h, inp_w = input_size
+    center, scale = box_to_center_scale(bbox[None], float(inp_w) / inp_h)
+    center, scale = center[0].numpy(), scale[0].numpy()
+    # get_affine_transform with no rotation or shift
+    src_dir = np.array([0, scale[0] * -0.5], np.float32)
+    dst_dir = np.array([0, inp_w * -0.5], np.float32)
+    src_points = np.float32([center, center + src_dir, center + src_dir + [src_dir[1], -src_dir[0]]])
+    dst_center = np.array([inp_w * 0.5, inp_h * 0.5], np.float32)
+    dst_points = np.float32([dst_center, dst_center + dst_dir, dst_center + dst_dir + [dst_dir[1], -dst_dir[0]]])
+    trans = cv2.getAffineTransform(src_points, dst_points)
+    img = cv2.warpAffine(src, trans, (int(inp_w), int(inp_h)), flags=cv2.INTER_LINEAR)
+    img = torch.from_numpy(np.transpose(img, (2, 0, 1)).copy()).float()
+    if img.max() > 1:
+        img /= 255
+    for channel, mean in enumerate(PIXEL_MEANS):
+        img[channel].add_(-mean)
+    return img, center_scale_to_box(torch.from_numpy(center)[None], torch.from_numpy(scale)[None])[0]
+
+
+def per_box(images, boxes, image_index):
+    inps = torch.zeros(boxes.shape[0], 3, *INPUT_SIZE)
+    cropped_boxes = torch.zeros(boxes.shape[0], 4)
+    for i, box in enumerate(boxes):
+        inps[i], cropped_boxes[i] = test_transform(images[image_index[i]], box)
+    return inps, cropped_boxes
+
+
+def random_boxes(count, width, height, generator):
+    xy = torch.rand(count, 2, generator=generator) * torch.tensor([width, height]) - 50
+    wh = torch.rand(count, 2, generator=generator) * torch.tensor([300.0, 500.0]) + 20
+    return torch.cat([xy, xy + wh], dim=1)
+
+
+def sampled(images, boxes, image_index, device):
+    center, scale = box_to_center_scale(boxes, float(INPUT_SIZE[1]) / INPUT_SIZE[0])
+    transforms = affine_transforms(center, scale, INPUT_SIZE)
+    images = [np.ascontiguousarray(image) for image in images]
+    inps = sample_crops(images, transforms, image_index, INPUT_SIZE, device).cpu()
+    return inps, center_scale_to_box(center, scale)
+
+
+@click.command()
+@click.option('--images', default=2)
+@click.option('--boxes', default=20, help="boxes per image")
+@click.option('--repeat', default=10)
+@click.option('--threads', default=None, type=int)
+@click.option('--device', default="cpu", help="device for the grid_sample path")
+def main(images, boxes, repeat, threads, device):
+    if threads:
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+    generator = torch.Generator().manual_seed(0)
+    # detection resolves frames as the RGB view of the decoded BGR frame
+    frames = [cv2.GaussianBlur(np.random.randint(0, 255, (1080, 1920, 3), dtype=np.uint8), (15, 15), 5)[:, :, ::-1]
+              for _ in range(images)]
+    all_boxes = torch.cat([random_boxes(boxes, 1920, 1080, generator) for _ in range(images)])
+    image_index = torch.arange(images).repeat_interleave(boxes)
+
+    paths = [
+        ("per box", per_box),
+        ("batched", lambda *args: crop_boxes(*args, INPUT_SIZE)),
+        (f"grid {device}", lambda *args: sampled(*args, device)),
+    ]
+    print(f"{images} images x {boxes} boxes")
+    print(f"{'path':<16}{'ms':>10}{'speedup':>10}{'max diff':>10}{'mean diff':>12}{'box diff':>10}")
+    reference = None
+    for name, crop in paths:
+        crop(frames, all_boxes, image_index)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            inps, cropped_boxes = crop(frames, all_boxes, image_index)
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        reference = reference or (elapsed, inps, cropped_boxes)
+        difference = (reference[1] - inps).abs()
+        print(f"{name:<16}{elapsed:>10.2f}{reference[0] / elapsed:>9.2f}x{difference.max():>10.5f}{difference.mean():>12.7f}"
+              f"{(reference[2] - cropped_boxes).abs().max():>10.5f}")
+    print(f"(one gray level is {1 / 255:.5f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Frames per second (and per core) of the eager YOLO detector against the exported detector backends
+of `producer.backends`, on the same letterboxed frames. Boxes are compared with the eager ones: the
+number of detections and the mean IoU of every eager box with its best match.
+
+`--save-calibration` writes letterboxed frames (other than the benchmark ones) for
+`DETECTOR_CALIBRATION`, static quantization is calibrated on them.
+
+    python scripts/bench_detector.py --video /data/sample.mp4 --threads 4 \
+        --backend torchscript:none --backend onnx:none --backend onnx:static
+"""
+import tempfile
+import time
+
+import click
+import cv2
+import numpy as np
+import torch
+from alphapose.utils.config import update_config
+from detector.apis import get_detector
+
+from producer.backends import DetectorBackend, box_iou, load_calibration
+from producer.beta.transforms import letterbox_batch
+from producer.helpers import ObjectView
+from producer.video import FrameSampling, read_frames
+
+
+def read_images(video, count, offset=0):
+    if not video:
+        return [cv2.GaussianBlur(np.random.RandomState(offset + i).randint(0, 255, (1080, 1920, 3), dtype=np.uint8), (15, 15), 5)
+                for i in range(count)]
+    stream = cv2.VideoCapture(video)
+    frame_count = int(stream.get(cv2.CAP_PROP_FRAME_COUNT))
+    stride = max(1, frame_count // (2 * count))
+    sampling = FrameSampling(stride=stride, start=offset * stride / (stream.get(cv2.CAP_PROP_FPS) or 10))
+    images = [image[:, :, ::-1] for _, image in read_frames(stream, sampling.frame_nums(stream.get(cv2.CAP_PROP_FPS), frame_count))]
+    stream.release()
+    return images[:count]
+
+
+def detect(detector, imgs, im_dim_list, batch_size, repeat):
+    dets = []
+    # the first batch loads or exports the model
+    detector.images_detection(imgs[:batch_size], im_dim_list[:batch_size])
+    started = time.perf_counter()
+    for _ in range(repeat):
+        dets = []
+        for start in range(0, len(imgs), batch_size):
+            batch_dets = detector.images_detection(imgs[start:start + batch_size], im_dim_list[start:start + batch_size])
+            if not isinstance(batch_dets, int):
+                batch_dets = torch.as_tensor(batch_dets).cpu().clone()
+                batch_dets[:, 0] += start
+                dets.append(batch_dets)
+    elapsed = (time.perf_counter() - started) / repeat
+    return (torch.cat(dets) if dets else torch.zeros(0, 8)), len(imgs) / elapsed
+
+
+def mean_best_iou(reference, dets):
+    ious = []
+    for k in reference[:, 0].unique():
+        ref_boxes = reference[reference[:, 0] == k, 1:5]
+        boxes = dets[dets[:, 0] == k, 1:5]
+        if not len(boxes):
+            ious += [0.0] * len(ref_boxes)
+            continue
+        ious += box_iou(torch.cat((ref_boxes, boxes)))[:len(ref_boxes), len(ref_boxes):].max(dim=1)[0].tolist()
+    return float(np.mean(ious)) if ious else 1.0
+
+
+@click.command()
+@click.option('--config', default="/build/AlphaPose/data/pose_cfgs/wf_alphapose_inference_config.yaml")
+@click.option('--detector', 'detector_name', default="yolov4")
+@click.option('--backend', 'backends', multiple=True, default=["torchscript:none", "onnx:none", "onnx:dynamic"],
+              help="backend:quantization, repeat for several")
+@click.option('--video', default=None, help="detect on frames of this video instead of synthetic ones")
+@click.option('--frames', default=16)
+@click.option('--batch-size', default=4)
+@click.option('--repeat', default=2)
+@click.option('--threads', default=0)
+@click.option('--calibration', default=None, help="calibration frames for static quantization, read from `--video` otherwise")
+@click.option('--save-calibration', default=None, help="write the calibration frames here for DETECTOR_CALIBRATION")
+@click.option('--cache-dir', default=None, help="where to export the models, a temporary directory by default")
+def main(config, detector_name, backends, video, frames, batch_size, repeat, threads, calibration, save_calibration, cache_dir):
+    if threads:
+        torch.set_num_threads(threads)
+    cores = torch.get_num_threads()
+    cfg = update_config(config)
+    args = ObjectView({"sp": True, "tracking": False, "detector": detector_name, "device": "cpu", "gpus": []})
+    detector = get_detector(args, cfg['DETECTOR'])
+    inp_dim = int(detector.inp_dim)
+    images = read_images(video, frames)
+    imgs = letterbox_batch(images, inp_dim)
+    im_dim_list = torch.FloatTensor([image.shape[1::-1] for image in images]).repeat(1, 2)
+    calibration = load_calibration(calibration)
+    if calibration is None:
+        calibration = letterbox_batch(read_images(video, frames, offset=frames), inp_dim)
+    if save_calibration:
+        torch.save(calibration, save_calibration)
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix="detector-backends-")
+
+    reference, reference_fps = detect(detector, imgs, im_dim_list, batch_size, repeat)
+    print(f"{'backend':<24}{'frames/s':>10}{'per core':>10}{'speedup':>10}{'boxes':>8}{'best iou':>10}")
+    print(f"{'eager:none':<24}{reference_fps:>10.2f}{reference_fps / cores:>10.2f}{1:>10.2f}{len(reference):>8}{1:>10.3f}")
+    for spec in backends:
+        name, _, quantization = spec.partition(":")
+        backend = DetectorBackend(detector, backend=name, quantization=quantization or "none", threads=threads,
+                                  cache_dir=cache_dir, calibration=calibration)
+        dets, fps = detect(backend, imgs, im_dim_list, batch_size, repeat)
+        print(f"{spec:<24}{fps:>10.2f}{fps / cores:>10.2f}{fps / reference_fps:>10.2f}{len(dets):>8}{mean_best_iou(reference, dets):>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Checks the pose backends of `producer.backends` against the eager fp32 model on a fixed set of crops:
+the speed per crop, how far the heatmaps are from the eager ones and how often the keypoint (the
+heatmap peak) lands on the same heatmap pixel.
+
+Crops are cut from person sized boxes of `--video` frames (seeded, the same crops on every run) or
+from synthetic frames. `--save-calibration` writes the separate calibration crops for
+`POSE_CALIBRATION`, static quantization is calibrated on them and the reduced precision self-check
+runs on them.
+
+A backend is `backend:quantization`, eager backends can add a precision and `+` separated execution
+modes, e.g. `eager:none:bf16:channels_last+inference_mode`. The self-check is off here, the table
+shows what it would compare.
+
+    python scripts/check_pose_backend.py --config /build/AlphaPose/data/pose_cfgs/wf_alphapose_inference_config.yaml \
+        --checkpoint /build/AlphaPose/pretrained_models/alphapose-wf_res152_256x192.0.2.yolov4.pth \
+        --video /data/sample.mp4 --backend torchscript:none --backend onnx:dynamic --backend onnx:static --threads 4 \
+        --backend eager:none:bf16 --backend eager:none:fp32:compile
+"""
+import tempfile
+import time
+
+import click
+import cv2
+import numpy as np
+import torch
+from alphapose.models import builder
+from alphapose.utils.config import update_config
+
+from producer.backends import PoseBackend, heatmap_peaks, model_key
+from producer.beta.transforms import crop_boxes
+from producer.video import FrameSampling, read_frames
+
+
+def read_images(video, count):
+    if not video:
+        return [cv2.GaussianBlur(np.random.RandomState(i).randint(0, 255, (1080, 1920, 3), dtype=np.uint8), (15, 15), 5)
+                for i in range(count)]
+    stream = cv2.VideoCapture(video)
+    frame_count = int(stream.get(cv2.CAP_PROP_FRAME_COUNT))
+    sampling = FrameSampling(stride=max(1, frame_count // count))
+    images = [image[:, :, ::-1] for _, image in read_frames(stream, sampling.frame_nums(stream.get(cv2.CAP_PROP_FPS), frame_count))]
+    stream.release()
+    return images[:count]
+
+
+def person_boxes(images, count, seed):
+    generator = torch.Generator().manual_seed(seed)
+    image_index = torch.randint(len(images), (count,), generator=generator)
+    height, width = images[0].shape[:2]
+    h = (torch.rand(count, generator=generator) * 0.3 + 0.3) * height
+    w = h * 0.45
+    x = torch.rand(count, generator=generator) * (width - w)
+    y = torch.rand(count, generator=generator) * (height - h)
+    return torch.stack([x, y, x + w, y + h], dim=1), image_index
+
+
+def crops(images, count, input_size, seed):
+    boxes, image_index = person_boxes(images, count, seed)
+    inps, _ = crop_boxes(images, boxes, image_index, input_size)
+    return inps
+
+
+def run(backend, inps, batch_size, repeat):
+    outputs = []
+    with torch.no_grad():
+        # the first call exports and loads the model
+        backend(inps[:batch_size])
+        started = time.perf_counter()
+        for _ in range(repeat):
+            outputs = [backend(chunk) for chunk in inps.split(batch_size)]
+        elapsed = time.perf_counter() - started
+    return torch.cat(outputs).float(), elapsed / repeat / len(inps) * 1000
+
+
+@click.command()
+@click.option('--config', required=True)
+@click.option('--checkpoint', required=True)
+@click.option('--backend', 'backends', multiple=True, default=["torchscript:none", "onnx:none", "onnx:dynamic"],
+              help="backend:quantization[:precision[:modes]], repeat for several")
+@click.option('--video', default=None, help="cut the crops from frames of this video instead of synthetic ones")
+@click.option('--crops', 'count', default=64)
+@click.option('--calibration', 'calibration_count', default=64, help="calibration crops for static quantization")
+@click.option('--save-calibration', default=None, help="write the calibration crops here for POSE_CALIBRATION")
+@click.option('--batch-size', default=16)
+@click.option('--repeat', default=3)
+@click.option('--threads', default=0)
+@click.option('--cache-dir', default=None, help="where to export the models, a temporary directory by default")
+def main(config, checkpoint, backends, video, count, calibration_count, save_calibration, batch_size, repeat, threads, cache_dir):
+    if threads:
+        torch.set_num_threads(threads)
+    cfg = update_config(config)
+    model = builder.build_sppe(cfg.MODEL, preset_cfg=cfg.DATA_PRESET)
+    model.load_state_dict(torch.load(checkpoint, map_location="cpu"))
+    model.eval()
+    input_size = cfg.DATA_PRESET.IMAGE_SIZE
+    images = read_images(video, 16)
+    inps = crops(images, count, input_size, seed=0)
+    calibration = crops(images, calibration_count, input_size, seed=1)
+    if save_calibration:
+        torch.save(calibration, save_calibration)
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix="pose-backends-")
+    key = model_key(checkpoint, input_size)
+
+    reference, reference_ms = run(PoseBackend(model, input_size, threads=threads), inps, batch_size, repeat)
+    reference_peaks = heatmap_peaks(reference)
+    print(f"{'backend':<24}{'ms/crop':>10}{'speedup':>10}{'max diff':>12}{'mean diff':>12}{'same peak':>12}{'peak dist':>12}")
+    print(f"{'eager:none':<24}{reference_ms:>10.2f}{1:>10.2f}{0:>12.4f}{0:>12.4f}{1:>12.3f}{0:>12.3f}")
+    for spec in backends:
+        name, quantization, precision, execution = (spec.split(":") + ["", "", ""])[:4]
+        backend = PoseBackend(model, input_size, backend=name, quantization=quantization or "none", threads=threads,
+                              cache_dir=cache_dir, key=key, calibration=calibration, precision=precision or "fp32",
+                              execution=execution.replace("+", ","), check_tolerance=None)
+        heatmaps, ms = run(backend, inps, batch_size, repeat)
+        diff = (heatmaps - reference).abs()
+        distance = (heatmap_peaks(heatmaps) - reference_peaks).norm(dim=2)
+        print(f"{spec:<24}{ms:>10.2f}{reference_ms / ms:>10.2f}{diff.max().item():>12.4f}{diff.mean().item():>12.4f}"
+              f"{(distance == 0).float().mean().item():>12.3f}{distance.mean().item():>12.3f}")
+
+
+if __name__ == '__main__':
+    main()